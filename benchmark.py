@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# 离线性能基准：合成 cnblogs 导出文件 + 本地 HTTP 服务模拟微信页面和图片，不访问外网。
+"""
+用法：
+    python benchmark.py                               # 运行全部场景
+    python benchmark.py xml-stream wechat-parallel    # 只运行指定场景
+    python benchmark.py --entries 2000 --images 5 --latency 0.05 --error-rate 0.02
+    python benchmark.py --save baseline.json          # 保存结果作为基线
+    python benchmark.py --compare baseline.json       # 与基线对比，吞吐下降超过 tolerance 时退出码为 1
+"""
+
+import argparse
+import base64
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import postHelper
+
+# 1x1 PNG，按需在末尾补齐到指定大小
+PNG_1X1 = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+PARAGRAPH = "<p>性能基准测试段落，包含<b>加粗</b>和<code>inline code</code>。Lorem ipsum dolor sit amet.</p>"
+CODE_BLOCK = "<pre><code>def handler(event):\n    return {'status': 200}\n</code></pre>"
+
+# 场景：kind 决定用哪个爬虫，其余参数传给爬虫构造函数
+SCENARIOS = {
+    "xml": {"kind": "xml"},
+    "xml-stream": {"kind": "xml", "stream": True},
+    "xml-processes": {"kind": "xml", "convert_processes": None},
+    "wechat": {"kind": "wechat", "max_workers": 1},
+    "wechat-parallel": {"kind": "wechat", "max_workers": 8},
+    # 关闭自适应限速，只测流水线本身的吞吐
+    "wechat-no-limit": {"kind": "wechat", "max_workers": 8, "rate_limit": False},
+}
+
+
+def article_html(index, image_urls, paragraphs):
+    parts = []
+    for i in range(paragraphs):
+        parts.append(PARAGRAPH)
+        if i % 5 == 4:
+            parts.append(CODE_BLOCK)
+    step = max(1, paragraphs // max(1, len(image_urls)))
+    for n, url in enumerate(image_urls):
+        parts.insert(min(len(parts), n * step), f'<img src="{url}"/>')
+    return f"<h2>Section {index}</h2>" + "".join(parts)
+
+
+def image_urls_for(base_url, article_id, images, shared_images):
+    """shared_images 张图片在所有文章间共用（模拟头像、二维码），其余每篇独有"""
+    urls = [f"{base_url}/img/shared/{n}.png" for n in range(min(shared_images, images))]
+    urls += [f"{base_url}/img/{article_id}/{n}.png?wx_fmt=png" for n in range(images - len(urls))]
+    return urls
+
+
+def generate_atom_export(path, entries=200, images=3, paragraphs=20, base_url="http://127.0.0.1:8000",
+                         shared_images=1):
+    """生成博客园格式的 Atom 导出文件，逐条写入，条目数不受内存限制"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom"><title>benchmark</title>\n')
+        for i in range(entries):
+            html = article_html(i, image_urls_for(base_url, f"x{i}", images, shared_images), paragraphs)
+            f.write(
+                "<entry>"
+                f"<title>Benchmark post {i}</title>"
+                f'<link rel="alternate" href="https://www.cnblogs.com/bench/p/{100000 + i}.html"/>'
+                f"<published>2020-{i % 12 + 1:02d}-{i % 28 + 1:02d}T08:00:00Z</published>"
+                "<author><name>bench</name></author>"
+                f'<content type="html">{escape(html)}</content>'
+                "</entry>\n"
+            )
+        f.write("</feed>\n")
+    return path
+
+
+def wechat_page(pid, base_url, images, paragraphs, shared_images):
+    urls = image_urls_for(base_url, pid, images, shared_images)
+    body = article_html(pid, urls, paragraphs).replace('<img src="', '<img data-src="')
+    return f"""<!DOCTYPE html><html><head>
+<meta property="og:image" content="{base_url}/img/{pid}/cover.png"/>
+<meta name="author" content="bench"/>
+<script>{"var padding = 1;" * 2000}</script>
+</head><body>
+<h1 class="rich_media_title"> Benchmark {pid} </h1>
+<script>var createTime = '2024-05-{sum(map(ord, pid)) % 28 + 1:02d} 10:00';</script>
+<script>var album = {{ album_info_list : [{{ albumId: '1', title: 'bench' }}] }};</script>
+<div id="js_content">{body}</div>
+</body></html>"""
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """/s/<pid> 返回微信风格页面，/img/... 返回图片；按配置注入延迟和 503 错误"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cfg = self.server.config
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+        if cfg["latency"]:
+            time.sleep(random.uniform(0.5, 1.5) * cfg["latency"])
+        if random.random() < cfg["error_rate"]:
+            with self.server.lock:
+                self.server.stats["errors"] += 1
+            self._send(503, b"", "text/plain")
+            return
+        path = self.path.split("?")[0]
+        if path.startswith("/s/"):
+            pid = path[3:]
+            page = wechat_page(pid, self.server.base_url, cfg["images"], cfg["paragraphs"], cfg["shared_images"])
+            self._send(200, page.encode("utf-8"), "text/html; charset=utf-8")
+        elif path.startswith("/img/"):
+            body = PNG_1X1 + b"\0" * max(0, cfg["image_bytes"] - len(PNG_1X1))
+            self._send(200, body, "image/png")
+        else:
+            self._send(404, b"", "text/plain")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_stand_in(latency=0.02, error_rate=0.0, image_bytes=20 * 1024, images=3, paragraphs=20, shared_images=1):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.config = {"latency": latency, "error_rate": error_rate, "image_bytes": image_bytes,
+                     "images": images, "paragraphs": paragraphs, "shared_images": shared_images}
+    server.stats = {"requests": 0, "errors": 0}
+    server.lock = threading.Lock()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def run_scenario(name, options, config, result_queue):
+    """在独立进程中运行，峰值内存只反映本场景"""
+    options = dict(options)
+    kind = options.pop("kind")
+    blog_root = os.path.join(config["workdir"], name)
+    common = {
+        "blog_root": blog_root,
+        "download_images": True,
+        "proxy": None,
+        "incremental": False,
+        "retry_policy": postHelper.RetryPolicy(max_retries=config["retries"], base_delay=0.05, max_delay=1),
+        # 与爬虫默认一致开启自适应限速，--no-rate-limit 时全部关闭
+        "rate_limit": config["rate_limit"],
+        "article_timeout": config["article_timeout"],
+        "hedge": config["hedge"],
+    }
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if kind == "xml":
+            crawler = postHelper.XmlArticleCrawler([config["xml_file"]], **dict(common, **options))
+            crawler.crawl()
+        else:
+            crawler = postHelper.WeChatArticleCrawler(**dict(common, **options))
+            crawler.ARTICLE_URL = config["base_url"] + "/s/{pid}"
+            crawler.crawl_batch([f"bench{i:05d}" for i in range(config["articles"])])
+        elapsed = time.perf_counter() - start
+    articles = count_files(os.path.join(blog_root, "_posts"))
+    images = count_files(os.path.join(blog_root, "images"))
+    result_queue.put({
+        "scenario": name,
+        "seconds": round(elapsed, 3),
+        "articles": articles,
+        "images": images,
+        "articles_per_sec": round(articles / elapsed, 2) if elapsed else 0.0,
+        "images_per_sec": round(images / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stage_seconds": {k: round(v, 3) for k, v in crawler.stage_seconds.items()},
+    })
+
+
+def print_report(results):
+    print(f"{'scenario':<16}{'articles':>9}{'art/s':>9}{'images':>8}{'img/s':>9}{'rss MB':>9}{'wall s':>9}  stages")
+    for r in results:
+        stages = " ".join(f"{k}={v:.2f}" for k, v in r["stage_seconds"].items())
+        print(f"{r['scenario']:<16}{r['articles']:>9}{r['articles_per_sec']:>9.2f}{r['images']:>8}"
+              f"{r['images_per_sec']:>9.2f}{r['peak_rss_mb']:>9.1f}{r['seconds']:>9.2f}  {stages}")
+
+
+def compare(results, baseline_path, tolerance):
+    """吞吐低于基线 (1 - tolerance) 倍或峰值内存高于 (1 + tolerance) 倍视为退化"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["scenario"])
+        if base is None:
+            continue
+        if r["articles_per_sec"] < base["articles_per_sec"] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}: articles/sec {r['articles_per_sec']} < baseline {base['articles_per_sec']}")
+        if r["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}: peak RSS {r['peak_rss_mb']} MB > baseline {base['peak_rss_mb']} MB")
+    for line in regressions:
+        print("REGRESSION", line)
+    return not regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="xmlTomd offline benchmark")
+    parser.add_argument("scenarios", nargs="*", help=f"可选 {', '.join(SCENARIOS)}，默认运行全部场景")
+    parser.add_argument("--entries", type=int, default=300, help="XML 导出中的文章数")
+    parser.add_argument("--articles", type=int, default=60, help="微信场景的文章数")
+    parser.add_argument("--images", type=int, default=3, help="每篇文章的图片数")
+    parser.add_argument("--shared-images", type=int, default=1, help="所有文章共用的图片数")
+    parser.add_argument("--paragraphs", type=int, default=30, help="每篇文章的段落数")
+    parser.add_argument("--image-kb", type=int, default=20, help="图片大小（KB）")
+    parser.add_argument("--latency", type=float, default=0.02, help="本地服务的平均响应延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 503 的概率")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--no-rate-limit", dest="rate_limit", action="store_false",
+                        help="所有场景关闭按 host 自适应限速（默认与爬虫一致开启）")
+    parser.add_argument("--article-timeout", type=float, help="单篇文章的处理时限（秒）")
+    parser.add_argument("--hedge", action="store_true", help="开启对冲请求")
+    parser.add_argument("--workdir", help="输出目录，默认使用临时目录并在结束后删除")
+    parser.add_argument("--save", help="把结果写入 JSON 文件")
+    parser.add_argument("--compare", help="与基线 JSON 对比")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="xmltomd-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    server = start_stand_in(latency=args.latency, error_rate=args.error_rate, image_bytes=args.image_kb * 1024,
+                            images=args.images, paragraphs=args.paragraphs, shared_images=args.shared_images)
+    config = {"workdir": workdir, "base_url": server.base_url, "articles": args.articles, "retries": args.retries,
+              "rate_limit": args.rate_limit, "article_timeout": args.article_timeout, "hedge": args.hedge}
+    if any(SCENARIOS[n]["kind"] == "xml" for n in names):
+        config["xml_file"] = generate_atom_export(
+            os.path.join(workdir, "export.xml"), entries=args.entries, images=args.images,
+            paragraphs=args.paragraphs, base_url=server.base_url, shared_images=args.shared_images)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for name in names:
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=run_scenario, args=(name, SCENARIOS[name], config, result_queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                print(f"scenario {name} failed with exit code {proc.exitcode}")
+                continue
+            results.append(result_queue.get())
+    finally:
+        server.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    print(f"stand-in server: {server.stats['requests']} requests, {server.stats['errors']} injected errors")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,18 +11,52 @@
 import os
 import re
 import hashlib
+import gzip
 import requests
+from requests.adapters import HTTPAdapter
 import traceback
+import json
+import logging
+import multiprocessing
+import sys
 import random
+import shutil
+import sqlite3
+import uuid
+import threading
+import queue
 import bs4
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+import filecmp
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor,
+                                TimeoutError as FutureTimeoutError, as_completed, wait)
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
+from markdownify import MarkdownConverter
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import time
+from contextlib import contextmanager, nullcontext
 # from lxml import etree
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+try:
+    from PIL import Image
+except ImportError:  # Pillow 为可选依赖，只有转 WebP、限制尺寸和生成缩略图时需要
+    Image = None
 
 
+# 默认只输出警告和错误；verbose=True 时输出每篇文章、每次请求的详细日志
+logger = logging.getLogger("xmlTomd")
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+# 转换规则（正文清理、front matter 等）变化时递增，已记录的文章会重新生成
+CONVERTER_VERSION = 1
+# 非法 XML 控制字符；UTF-8 多字节序列不会出现 0x00-0x1F，按字节分块清理是安全的
+XML_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0B-\x0C\x0E-\x1F]")
+XML_CONTROL_CHARS_BYTES = re.compile(rb"[\x00-\x08\x0B-\x0C\x0E-\x1F]")
+
 HEADER = """---
 layout:     post
 title:      "{title}"
@@ -38,12 +72,1677 @@ tags:
 ---
 """
 
+class JekyllMarkdownConverter(MarkdownConverter):
+    """
+    HTML→Markdown 转换器，微信和 XML 两条路径共用，转换选项和自定义标签规则都写在这里。
+    convert_soup 可以直接转换已解析、已改写的 Tag，不必先序列化再重新解析。
+    """
+    def __init__(self, **options):
+        options.setdefault("heading_style", "ATX")
+        options.setdefault("code_language_detection", True)
+        super().__init__(**options)
+
+    def convert_soup(self, soup):
+        text = super().convert_soup(soup)
+        if not isinstance(soup, BeautifulSoup):
+            # 与转换整篇文档时一致，去掉首尾多余的换行
+            text = self.convert__document_(soup, text, set())
+        return text
+
+
+MARKDOWN_CONVERTER = JekyllMarkdownConverter()
+
+
+def html_to_markdown(html):
+    """HTML 字符串或已解析的 Tag 转 Markdown；模块级函数，可以直接提交到进程池"""
+    if isinstance(html, bs4.element.Tag):
+        return MARKDOWN_CONVERTER.convert_soup(html)
+    return MARKDOWN_CONVERTER.convert(html)
+
+
+def enable_verbose_logging(level=logging.INFO):
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+class DownloadManager:
+    """
+    有界线程池下载管理器：全局最多 max_workers 个并发下载，
+    同一 host 最多 per_host_limit 个，超出的任务按 host 排队，不占用工作线程。
+    """
+    def __init__(self, download_func, max_workers=8, per_host_limit=4):
+        self.download_func = download_func
+        self.per_host_limit = per_host_limit
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._lock = threading.Lock()
+        self._active = {}
+        self._pending = {}
+
+    def submit(self, url, dest_path):
+        """任务继承提交线程的截止时间（见 deadline_scope），到期时排队中的任务直接失败"""
+        future = Future()
+        host = urlparse(url).netloc
+        task = (url, dest_path, future, current_deadline())
+        with self._lock:
+            if self._active.get(host, 0) < self.per_host_limit:
+                self._active[host] = self._active.get(host, 0) + 1
+                start = True
+            else:
+                self._pending.setdefault(host, deque()).append(task)
+                start = False
+        if start:
+            self._start(host, *task)
+        return future
+
+    def _start(self, host, url, dest_path, future, deadline):
+        self.executor.submit(self._run, host, url, dest_path, future, deadline)
+
+    def _run(self, host, url, dest_path, future, deadline):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    if deadline is not None:
+                        deadline.check()
+                    with deadline_scope(deadline):
+                        future.set_result(self.download_func(url, dest_path))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            with self._lock:
+                queue = self._pending.get(host)
+                nxt = queue.popleft() if queue else None
+                if nxt is None:
+                    self._active[host] -= 1
+            if nxt is not None:
+                self._start(host, *nxt)
+
+    def batch(self):
+        return DownloadBatch(self)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class DownloadBatch:
+    """一篇文章的下载任务集合，wait() 等待本批次全部完成"""
+    def __init__(self, manager):
+        self.manager = manager
+        self.futures = []
+        self.permanent = set()
+
+    def add(self, url, dest_path):
+        future = self.manager.submit(url, dest_path)
+        self.futures.append((url, future))
+        return future
+
+    def wait(self):
+        """
+        返回下载失败的 url 列表；超过当前截止时间时取消尚未开始的下载，都算失败。
+        其中服务器明确拒绝（PermanentDownloadError）的 url 同时记入 permanent。
+        """
+        failed = []
+        self.permanent = set()
+        deadline = current_deadline()
+        for url, future in self.futures:
+            try:
+                ok = future.result(timeout=max(0, deadline.remaining()) if deadline else None)
+            except FutureTimeoutError:
+                future.cancel()
+                logger.warning(f"Cancelled download {url} (deadline exceeded)")
+                ok = False
+            except PermanentDownloadError:
+                self.permanent.add(url)
+                ok = False
+            except Exception as e:
+                logger.warning(f"Failed to download {url} ({e})")
+                ok = False
+            if not ok:
+                failed.append(url)
+        self.futures = []
+        return failed
+
+
+class AssetStore:
+    """
+    按内容寻址的图片仓库：文件按内容 sha256 保存在 <root>/<hh>/<hash>，
+    url→hash 索引以追加方式持久化到 <root>/index.tsv。
+    已知 url 不再发请求；相同内容只存一份，文章目录中用硬链接引用（不支持时复制）。
+    """
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.index_path = os.path.join(root, "index.tsv")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    url, _, digest = line.rstrip("\n").rpartition("\t")
+                    if url:
+                        self.index[url] = digest
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lookup(self, url):
+        """已下载过且文件仍在时返回 hash"""
+        digest = self.index.get(url)
+        if digest and os.path.exists(self.path_for(digest)):
+            return digest
+        return None
+
+    def url_lock(self, url):
+        """同一 url 的并发请求串行化，避免重复下载"""
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def new_tmp_path(self):
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    def put(self, url, tmp_path):
+        """把下载好的临时文件收入仓库，返回 hash"""
+        h = hashlib.sha256()
+        with open(tmp_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        store_path = self.path_for(digest)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        if os.path.exists(store_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, store_path)
+        with self._lock:
+            self.index[url] = digest
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(f"{url}\t{digest}\n")
+        return digest
+
+    def link(self, digest, dest_path):
+        self.link_file(self.path_for(digest), dest_path)
+
+    def derived_path(self, digest, variant):
+        """同一原图按相同参数处理后的结果也只存一份"""
+        return os.path.join(self.root, "derived", digest[:2], f"{digest}-{variant}")
+
+    @staticmethod
+    def link_file(store_path, dest_path):
+        """硬链接到目标路径，不支持时复制；先写临时文件再替换，目标已存在时原子覆盖"""
+        if os.path.exists(dest_path) and os.path.samefile(store_path, dest_path):
+            return
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            os.link(store_path, tmp_path)
+        except OSError:
+            shutil.copyfile(store_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+
+
+# 文件头魔数 → 扩展名；WebP / AVIF 需要看偏移处的标记，单独判断
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"\x00\x00\x01\x00", "ico"),
+)
+CONTENT_TYPE_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/gif": "gif",
+    "image/webp": "webp",
+    "image/avif": "avif",
+    "image/bmp": "bmp",
+    "image/x-icon": "ico",
+    "image/vnd.microsoft.icon": "ico",
+    "image/svg+xml": "svg",
+}
+# Pillow 能可靠读写、值得转码或缩放的格式
+RASTER_FORMATS = {"png", "jpg", "gif", "webp", "bmp"}
+PIL_SAVE_FORMATS = {"png": "PNG", "jpg": "JPEG", "gif": "GIF", "webp": "WEBP", "bmp": "BMP"}
+
+
+def detect_image_format(path, content_type=None):
+    """按文件头识别图片格式，识别不了再看 Content-Type，都不行返回 None"""
+    with open(path, "rb") as f:
+        head = f.read(64)
+    for magic, ext in IMAGE_SIGNATURES:
+        if head.startswith(magic):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"):
+        return "avif"
+    if b"<svg" in head or (head.lstrip().startswith(b"<?xml") and b"svg" in head):
+        return "svg"
+    if content_type:
+        return CONTENT_TYPE_EXTENSIONS.get(content_type.split(";")[0].strip().lower())
+    return None
+
+
+# 微信图片 CDN 上只影响展示方式的参数，去掉后同一张图只有一个地址
+WECHAT_IMAGE_HOSTS = ("mmbiz.qpic.cn", "mmbiz.qlogo.cn")
+WECHAT_IMAGE_PARAMS = {"wx_fmt", "tp", "wxfrom", "wx_lazy", "wx_co", "from", "watermark"}
+WX_FMT_EXTENSIONS = {"jpeg": "jpg", "jpg": "jpg", "png": "png", "gif": "gif", "webp": "webp", "bmp": "bmp"}
+
+
+def canonical_asset_url(url):
+    """规范化图片地址：去掉 #片段、查询参数排序；微信 CDN 统一 https 并去掉 wx_fmt、tp 等参数"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    query = parse_qsl(parsed.query, keep_blank_values=True)
+    scheme = parsed.scheme
+    if host in WECHAT_IMAGE_HOSTS:
+        scheme = "https"
+        query = [(k, v) for k, v in query if k not in WECHAT_IMAGE_PARAMS]
+    return urlunparse((scheme, host, parsed.path, parsed.params, urlencode(sorted(query)), ""))
+
+
+def asset_request_url(url):
+    """实际请求的图片地址：微信 CDN 去掉 wx_fmt 等参数；其它 host 原样请求，签名地址的参数不能改动"""
+    url = url.strip()
+    return canonical_asset_url(url) if urlparse(url).netloc.lower() in WECHAT_IMAGE_HOSTS else url
+
+
+def guess_image_extension(url):
+    """下载前按 wx_fmt 参数或路径后缀推测扩展名，推测不出时为 png"""
+    parsed = urlparse(url)
+    wx_fmt = dict(parse_qsl(parsed.query)).get("wx_fmt", "").lower()
+    if wx_fmt in WX_FMT_EXTENSIONS:
+        return WX_FMT_EXTENSIONS[wx_fmt]
+    ext = os.path.splitext(parsed.path)[1].lower().lstrip(".")
+    ext = "jpg" if ext == "jpeg" else ext
+    return ext if ext in CONTENT_TYPE_EXTENSIONS.values() else "png"
+
+
+class AssetPlan:
+    """
+    两阶段模式的图片清单：规范化地址 → 目标路径。
+    plan 阶段只登记不下载，写成 JSON Lines，每行 {"url"（实际请求的地址）, "targets", "sources"}；
+    execute 阶段每个地址只下载一次，再链接到其余目标路径。清单也可以交给外部下载工具。
+    """
+    def __init__(self):
+        self.assets = {}
+        self._lock = threading.Lock()
+
+    def add(self, url, target):
+        canonical = canonical_asset_url(url)
+        with self._lock:
+            entry = self.assets.setdefault(canonical, {"url": asset_request_url(url), "targets": [], "sources": []})
+            if target not in entry["targets"]:
+                entry["targets"].append(target)
+            if url not in entry["sources"]:
+                entry["sources"].append(url)
+
+    def __len__(self):
+        return len(self.assets)
+
+    def write(self, path):
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self.assets.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        plan = cls()
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    plan.assets[canonical_asset_url(entry["url"])] = entry
+        return plan
+
+    def write_aria2(self, path):
+        """aria2c -i 的输入文件：每个地址下载到第一个目标路径，之后运行 execute_plan 补齐其余路径"""
+        with open(path, "w", encoding="utf-8") as f:
+            for entry in self.assets.values():
+                target = entry["targets"][0]
+                f.write(f"{entry['url']}\n  dir={os.path.dirname(os.path.abspath(target))}\n"
+                        f"  out={os.path.basename(target)}\n")
+
+
+class AssetProcessor:
+    """
+    下载后的图片处理：按真实格式修正扩展名；安装 Pillow 时可选转为 WebP、限制最大边长，
+    并为封面生成小缩略图。处理在独立线程池中并行，开启去重时处理结果也存进仓库复用。
+    """
+    def __init__(self, workers=4, webp=False, max_dimension=None, thumbnail_size=480, quality=82, store=None):
+        self.webp = webp
+        self.max_dimension = max_dimension
+        self.thumbnail_size = thumbnail_size
+        self.quality = quality
+        self.store = store
+        if Image is None and (webp or max_dimension):
+            logger.warning("Pillow is not installed, images will not be transcoded or resized")
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def transforms_enabled(self):
+        return Image is not None and bool(self.webp or self.max_dimension)
+
+    def submit(self, path, content_type=None, url=None):
+        """返回 Future，结果为处理后的文件路径"""
+        return self.pool.submit(self.process, path, content_type, url)
+
+    def submit_thumbnail(self, path, url=None):
+        """返回 Future，结果为缩略图路径，不生成时为 None"""
+        return self.pool.submit(self.make_thumbnail, path, url)
+
+    def process(self, path, content_type=None, url=None):
+        ext = detect_image_format(path, content_type) or "png"
+        base = os.path.splitext(path)[0]
+        if ext in RASTER_FORMATS and self.transforms_enabled:
+            out_ext = "webp" if self.webp and not self._animated(path) else ext
+            target = f"{base}.{out_ext}"
+            self._derive(path, target, out_ext, self.max_dimension, url)
+            if target != path:
+                os.remove(path)
+            return target
+        target = f"{base}.{ext}"
+        if target != path:
+            os.replace(path, target)
+        return target
+
+    def make_thumbnail(self, path, url=None):
+        """生成 <name>-small.<ext>，长边不超过 thumbnail_size；既不用缩小也不用转码时不生成"""
+        if Image is None or not self.thumbnail_size:
+            return None
+        ext = detect_image_format(path)
+        if ext not in RASTER_FORMATS or self._animated(path):
+            return None
+        out_ext = "webp" if self.webp else ext
+        with Image.open(path) as im:
+            small_enough = max(im.size) <= self.thumbnail_size
+        if small_enough and out_ext == ext:
+            return None
+        base = os.path.splitext(path)[0]
+        target = f"{base}-small.{out_ext}"
+        self._derive(path, target, out_ext, self.thumbnail_size, url)
+        return target
+
+    def _animated(self, path):
+        with Image.open(path) as im:
+            return getattr(im, "is_animated", False)
+
+    def _derive(self, src, target, out_ext, max_dimension, url):
+        """
+        处理结果先写临时文件再原子替换，不会改动与仓库硬链接的原图。
+        开启去重时按 原图hash-参数 缓存，同一张图只处理一次。
+        """
+        store = self.store
+        digest = store.index.get(url) if store and url else None
+        if digest:
+            cached = store.derived_path(digest, f"{max_dimension or 0}-{self.quality}.{out_ext}")
+            if not os.path.exists(cached):
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                self._transform(src, cached, out_ext, max_dimension)
+            store.link_file(cached, target)
+        else:
+            self._transform(src, target, out_ext, max_dimension)
+
+    def _transform(self, src, target, out_ext, max_dimension):
+        tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        with Image.open(src) as im:
+            if max_dimension and max(im.size) > max_dimension:
+                im.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            fmt = PIL_SAVE_FORMATS[out_ext]
+            if fmt == "JPEG" and im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            options = {"quality": self.quality} if fmt in ("JPEG", "WEBP") else {}
+            im.save(tmp_path, fmt, **options)
+        os.replace(tmp_path, target)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class Manifest:
+    """
+    增量运行清单（SQLite）：记录每篇文章的来源 id、来源内容 hash、转换器版本、输出选项摘要和输出文件。
+    都一致且输出文件都在时，该文章在下次运行中整体跳过。
+    options 为影响输出的选项（如 webp、max_image_dimension），改动后已有文章都视为过期；
+    没有记录选项的旧条目不按选项判断。
+    """
+    def __init__(self, path, options=None):
+        self.path = path
+        self.options = hashlib.md5(json.dumps(options or {}, sort_keys=True).encode("utf-8")).hexdigest()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS articles ("
+                "source_id TEXT PRIMARY KEY, content_hash TEXT, converter_version INTEGER, "
+                "outputs TEXT, updated_at TEXT, options TEXT)"
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(articles)")]
+            if "options" not in columns:
+                self.conn.execute("ALTER TABLE articles ADD COLUMN options TEXT")
+
+    def is_current(self, source_id, content_hash=None):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT content_hash, converter_version, outputs, options FROM articles WHERE source_id = ?",
+                (source_id,)
+            ).fetchone()
+        if row is None or row[1] != CONVERTER_VERSION:
+            return False
+        if row[3] is not None and row[3] != self.options:
+            return False
+        if content_hash is not None and row[0] != content_hash:
+            return False
+        return all(os.path.exists(p) for p in json.loads(row[2]))
+
+    def record(self, source_id, content_hash, outputs):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO articles "
+                "(source_id, content_hash, converter_version, outputs, updated_at, options) VALUES (?, ?, ?, ?, ?, ?)",
+                (source_id, content_hash, CONVERTER_VERSION, json.dumps(outputs, ensure_ascii=False),
+                 datetime.now().isoformat(timespec="seconds"), self.options)
+            )
+
+
+# 搜索分词：英文数字按词，中日韩文字按连续片段切成二元组
+SEARCH_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+FRONT_MATTER_PATTERN = re.compile(r"\A---\n(.*?)\n---\n", re.S)
+MARKDOWN_NOISE_PATTERN = re.compile(r"!\[[^\]]*\]\([^)]*\)|\]\([^)]*\)|https?://\S+")
+
+
+def tokenize(text):
+    """小写后切词；CJK 片段输出相邻二字组合，单字片段输出单字。前端搜索框需用同样规则切分"""
+    tokens = []
+    for word in SEARCH_TOKEN_PATTERN.findall(text.lower()):
+        if word.isascii():
+            if len(word) > 1 or word.isdigit():
+                tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def search_shard(term):
+    """分片按词首字符：ASCII 直接用该字符，其他字符按码位每 64 个一组，如 "_4e0" """
+    c = term[0]
+    return c if c.isascii() else f"_{ord(c) >> 6:x}"
+
+
+class SearchIndex:
+    """
+    预计算的站内搜索倒排索引，输出到 <output_dir>/docs.json 和 <output_dir>/shards/<前缀>.json。
+    分片格式 {词: [[文章编号, 权重], ...]}，按权重降序；docs.json 为 {文章编号: [标题, 日期, 文件名, 标签]}。
+    倒排表保存在 SQLite 中，保存文章时只更新该文章的词条并标记受影响的分片，flush 时只重写这些分片。
+    """
+    TITLE_WEIGHT = 10
+    TAG_WEIGHT = 5
+    BODY_MAX = 20
+
+    def __init__(self, output_dir, db_path):
+        self.output_dir = output_dir
+        self.shards_dir = os.path.join(output_dir, "shards")
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, title TEXT, "
+                "date TEXT, tags TEXT, digest TEXT, mtime REAL, size INTEGER)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT, shard TEXT, doc INTEGER, score INTEGER)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS postings_shard ON postings (shard)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+            # 未写出的分片（空字符串代表 docs.json），进程中断后下次 flush 仍会重写
+            self.conn.execute("CREATE TABLE IF NOT EXISTS dirty (shard TEXT PRIMARY KEY)")
+
+    @staticmethod
+    def parse_post(content):
+        """从 markdown 中取 front matter 的 title、date、tags 和正文"""
+        m = FRONT_MATTER_PATTERN.match(content)
+        header, body = (m.group(1), content[m.end():]) if m else ("", content)
+        fields, tags, in_tags = {}, [], False
+        for line in header.splitlines():
+            if in_tags and line.lstrip().startswith("- "):
+                tags.append(line.lstrip()[2:].strip())
+                continue
+            key, _, value = line.partition(":")
+            in_tags = key == "tags"
+            fields[key.strip()] = value.strip().strip('"')
+        return fields.get("title", ""), fields.get("date", ""), tags, body
+
+    def score_terms(self, title, tags, body):
+        scores = {}
+        for term in tokenize(title):
+            scores[term] = scores.get(term, 0) + self.TITLE_WEIGHT
+        for term in tokenize(" ".join(tags)):
+            scores[term] = scores.get(term, 0) + self.TAG_WEIGHT
+        body_counts = {}
+        for term in tokenize(MARKDOWN_NOISE_PATTERN.sub(" ", body)):
+            body_counts[term] = body_counts.get(term, 0) + 1
+        for term, n in body_counts.items():
+            scores[term] = scores.get(term, 0) + min(n, self.BODY_MAX)
+        return scores
+
+    def add_post(self, filepath, content):
+        """保存文章后调用；内容没变时不做任何事"""
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        digest = hashlib.md5(content.encode("utf-8")).hexdigest()
+        stat = os.stat(filepath)
+        with self._lock:
+            row = self.conn.execute("SELECT id, digest FROM docs WHERE name = ?", (name,)).fetchone()
+        if row and row[1] == digest:
+            with self._lock, self.conn:
+                self.conn.execute("UPDATE docs SET mtime = ?, size = ? WHERE id = ?", (stat.st_mtime, stat.st_size, row[0]))
+            return
+        title, date, tags, body = self.parse_post(content)
+        scores = self.score_terms(title, tags, body)
+        with self._lock, self.conn:
+            # 分词期间可能有其他线程写入了同一篇（如 sync_posts），重新读取
+            row = self.conn.execute("SELECT id, digest FROM docs WHERE name = ?", (name,)).fetchone()
+            if row and row[1] == digest:
+                self.conn.execute("UPDATE docs SET mtime = ?, size = ? WHERE id = ?", (stat.st_mtime, stat.st_size, row[0]))
+                return
+            if row:
+                doc_id = row[0]
+                self._mark_doc_dirty(doc_id)
+                self.conn.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+                self.conn.execute(
+                    "UPDATE docs SET title = ?, date = ?, tags = ?, digest = ?, mtime = ?, size = ? WHERE id = ?",
+                    (title, date, json.dumps(tags, ensure_ascii=False), digest, stat.st_mtime, stat.st_size, doc_id)
+                )
+            else:
+                doc_id = self.conn.execute(
+                    "INSERT INTO docs (name, title, date, tags, digest, mtime, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (name, title, date, json.dumps(tags, ensure_ascii=False), digest, stat.st_mtime, stat.st_size)
+                ).lastrowid
+            self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+                                  [(term, search_shard(term), doc_id, score) for term, score in scores.items()])
+            self._mark_doc_dirty(doc_id)
+            self.conn.execute("INSERT OR IGNORE INTO dirty VALUES ('')")
+
+    def _mark_doc_dirty(self, doc_id):
+        self.conn.execute("INSERT OR IGNORE INTO dirty SELECT DISTINCT shard FROM postings WHERE doc = ?", (doc_id,))
+
+    def sync_posts(self, posts_dir):
+        """补上不是本次运行保存的文章（如开启索引前已有的），移除已删除的文章；按 mtime 和大小判断是否变化"""
+        with self._lock:
+            known = {name: (doc_id, mtime, size) for doc_id, name, mtime, size
+                     in self.conn.execute("SELECT id, name, mtime, size FROM docs")}
+        seen = set()
+        for entry in os.scandir(posts_dir):
+            if not entry.name.endswith(".md"):
+                continue
+            name = entry.name[:-3]
+            seen.add(name)
+            stat = entry.stat()
+            old = known.get(name)
+            if old and old[1] == stat.st_mtime and old[2] == stat.st_size:
+                continue
+            with open(entry.path, "r", encoding="utf-8") as f:
+                self.add_post(entry.path, f.read())
+        with self._lock, self.conn:
+            for name, (doc_id, _, _) in known.items():
+                if name not in seen:
+                    self._mark_doc_dirty(doc_id)
+                    self.conn.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+                    self.conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+                    self.conn.execute("INSERT OR IGNORE INTO dirty VALUES ('')")
+
+    def flush(self):
+        """重写有变化的分片和 docs.json，返回重写的分片数"""
+        os.makedirs(self.shards_dir, exist_ok=True)
+        with self._lock, self.conn:
+            dirty = [row[0] for row in self.conn.execute("SELECT shard FROM dirty")]
+            for shard in dirty:
+                if shard == "":
+                    docs = {doc_id: [title, date, name, json.loads(tags)] for doc_id, name, title, date, tags
+                            in self.conn.execute("SELECT id, name, title, date, tags FROM docs ORDER BY id")}
+                    self._write_json(os.path.join(self.output_dir, "docs.json"), docs)
+                    continue
+                postings = {}
+                for term, doc_id, score in self.conn.execute(
+                        "SELECT term, doc, score FROM postings WHERE shard = ? ORDER BY term, score DESC, doc",
+                        (shard,)):
+                    postings.setdefault(term, []).append([doc_id, score])
+                path = os.path.join(self.shards_dir, f"{shard}.json")
+                if postings:
+                    self._write_json(path, postings)
+                elif os.path.exists(path):
+                    os.remove(path)
+            self.conn.execute("DELETE FROM dirty")
+        return len([shard for shard in dirty if shard])
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+
+class PageArchive:
+    """
+    原始页面归档：每条记录是一个独立的 gzip 成员，依次追加到 <root>/pages.gz（整个文件可直接 zcat），
+    成员内容为一行 JSON 头（url、key、抓取时间）加页面正文。
+    <root>/pages.idx 按行追加 url、偏移、长度、内容 md5，同一 url 以最后一条为准；内容没变时不重复写入。
+    """
+    def __init__(self, root):
+        self.root = root
+        self.data_path = os.path.join(root, "pages.gz")
+        self.index_path = os.path.join(root, "pages.idx")
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) == 4:
+                        self.index[parts[0]] = (int(parts[1]), int(parts[2]), parts[3])
+
+    def put(self, url, text, key=None, content_hash=None):
+        content_hash = content_hash or hashlib.md5(text.encode("utf-8")).hexdigest()
+        old = self.index.get(url)
+        if old and old[2] == content_hash:
+            return
+        header = {"url": url, "key": key, "fetched_at": datetime.now().isoformat(timespec="seconds")}
+        record = gzip.compress((json.dumps(header, ensure_ascii=False) + "\n" + text).encode("utf-8"))
+        with self._lock:
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(record)
+            # 正文写完再写索引，中断时索引不会指向残缺的记录
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(f"{url}\t{offset}\t{len(record)}\t{content_hash}\n")
+            self.index[url] = (offset, len(record), content_hash)
+
+    @staticmethod
+    def read_record(f, offset, length):
+        """返回 (头信息, 页面正文)"""
+        f.seek(offset)
+        header, _, text = gzip.decompress(f.read(length)).decode("utf-8").partition("\n")
+        return json.loads(header), text
+
+    def get(self, url):
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        with open(self.data_path, "rb") as f:
+            return self.read_record(f, entry[0], entry[1])[1]
+
+    def records(self):
+        """[(url, 偏移, 长度)]，每个 url 只取最新一条，按在文件中的顺序"""
+        return sorted(((url, offset, length) for url, (offset, length, _) in self.index.items()),
+                      key=lambda r: r[1])
+
+
+class HttpCache:
+    """
+    磁盘 HTTP 缓存：每个 url 对应 <root>/<sha1>.body 和 <sha1>.json（ETag、Last-Modified 等）。
+    有效期内直接用缓存；过期后带 If-None-Match / If-Modified-Since 请求，304 时继续用缓存。
+    default_ttl 为默认有效期（秒），ttl_rules 为 [(url 正则, 秒)]，匹配的 url 按规则覆盖，
+    如经常变化的分类页可设为 0（每次都重新验证）。总大小超过 max_bytes 时按最近使用时间淘汰。
+    """
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024, default_ttl=24 * 3600, ttl_rules=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttl_rules = [(re.compile(p), ttl) for p, ttl in (ttl_rules or [])]
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        # key -> [size, last_used]
+        self._usage = {}
+        self._total = 0
+        for name in os.listdir(root):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self._usage[name[:-5]] = [meta["size"], meta["last_used"]]
+                self._total += meta["size"]
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.root, key + ".body"), os.path.join(self.root, key + ".json")
+
+    def ttl_for(self, url):
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, url):
+        """返回缓存条目（meta 字典，含 body_path、fresh），没有则返回 None"""
+        body_path, meta_path = self._paths(self._key(url))
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(body_path):
+            return None
+        meta["body_path"] = body_path
+        meta["fresh"] = time.time() - meta["validated_at"] < self.ttl_for(url)
+        if meta["fresh"]:
+            self._touch(meta)
+        return meta
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def revalidated(self, entry):
+        """收到 304：刷新验证时间"""
+        entry["validated_at"] = time.time()
+        self._touch(entry)
+
+    def read_bytes(self, entry):
+        with open(entry["body_path"], "rb") as f:
+            return f.read()
+
+    def read_text(self, entry):
+        return self.read_bytes(entry).decode(entry.get("encoding") or "utf-8", errors="replace")
+
+    def store(self, url, headers, body, encoding=None):
+        """缓存响应体（bytes）"""
+        key = self._key(url)
+        body_path, _ = self._paths(key)
+        tmp_path = f"{body_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, body_path)
+        self._write_meta(url, key, headers, len(body), encoding)
+
+    def store_file(self, url, headers, src_path):
+        """缓存已下载到磁盘的文件"""
+        key = self._key(url)
+        body_path, _ = self._paths(key)
+        tmp_path = f"{body_path}.{uuid.uuid4().hex[:8]}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, body_path)
+        self._write_meta(url, key, headers, os.path.getsize(body_path), None)
+
+    def _write_meta(self, url, key, headers, size, encoding):
+        now = time.time()
+        meta = {"url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+                "encoding": encoding, "size": size, "validated_at": now, "last_used": now}
+        self._save_meta(key, meta)
+        with self._lock:
+            old = self._usage.get(key)
+            self._total += size - (old[0] if old else 0)
+            self._usage[key] = [size, now]
+        self.evict()
+
+    def _save_meta(self, key, meta):
+        _, meta_path = self._paths(key)
+        meta = {k: v for k, v in meta.items() if k not in ("body_path", "fresh")}
+        tmp_path = f"{meta_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+
+    def _touch(self, entry):
+        key = self._key(entry["url"])
+        entry["last_used"] = time.time()
+        self._save_meta(key, entry)
+        with self._lock:
+            if key in self._usage:
+                self._usage[key][1] = entry["last_used"]
+
+    def evict(self):
+        with self._lock:
+            if self._total <= self.max_bytes:
+                return
+            victims = []
+            for key, (size, _) in sorted(self._usage.items(), key=lambda kv: kv[1][1]):
+                if self._total <= self.max_bytes:
+                    break
+                victims.append(key)
+                self._total -= size
+                del self._usage[key]
+        for key in victims:
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class Metrics:
+    """
+    运行指标：各阶段每篇文章的耗时（次数、总和、最大值）和计数器（重试、下载字节、失败等），
+    结束时写出 JSON 和 Prometheus 文本格式。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        # stage -> [次数, 总耗时, 最大耗时]
+        self.stages = {}
+        self.counters = {}
+        # 带标签的分组指标，如 {"proxy": ("proxy", {"direct": {"requests": 10}})}
+        self.labeled = {}
+
+    def set_labeled(self, name, label, values):
+        """整体替换一组带标签的指标，values 为 {标签值: {字段: 数值}}"""
+        with self._lock:
+            self.labeled[name] = (label, values)
+
+    def observe_stage(self, name, seconds):
+        with self._lock:
+            stat = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    @property
+    def stage_seconds(self):
+        return {name: stat[1] for name, stat in self.stages.items()}
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "elapsed_seconds": round(time.time() - self.started_at, 3),
+                "stages": {name: {"count": c, "seconds": round(total, 4), "max_seconds": round(mx, 4),
+                                  "avg_seconds": round(total / c, 4) if c else 0.0}
+                           for name, (c, total, mx) in self.stages.items()},
+                "counters": dict(self.counters),
+                **{name: values for name, (_, values) in self.labeled.items()},
+            }
+
+    def to_prometheus(self, prefix="xmltomd"):
+        data = self.to_dict()
+        lines = [f"# TYPE {prefix}_run_seconds gauge", f"{prefix}_run_seconds {data['elapsed_seconds']}"]
+        for metric, key, kind in (("stage_calls_total", "count", "counter"),
+                                  ("stage_seconds_total", "seconds", "counter"),
+                                  ("stage_seconds_max", "max_seconds", "gauge")):
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, stat in data["stages"].items():
+                lines.append(f'{prefix}_{metric}{{stage="{name}"}} {stat[key]}')
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        for name, (label, values) in sorted(self.labeled.items()):
+            fields = sorted({field for stat in values.values() for field in stat})
+            for field in fields:
+                lines.append(f"# TYPE {prefix}_{name}_{field} gauge")
+                for key, stat in values.items():
+                    if field in stat:
+                        lines.append(f'{prefix}_{name}_{field}{{{label}="{key}"}} {stat[field]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "metrics.json"), "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        with open(os.path.join(directory, "metrics.prom"), "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+
+
+class ProgressReporter:
+    """后台线程定期在 stderr 输出进度：完成数、吞吐和预计剩余时间（总数未知时不显示）"""
+    def __init__(self, metrics, total=None, interval=2.0):
+        self.metrics = metrics
+        self.total = total
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self.started_at = time.time()
+
+    def done(self):
+        return sum(self.metrics.get(k) for k in ("articles_written", "articles_failed", "articles_skipped"))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.report(final=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self, final=False):
+        done = self.done()
+        elapsed = time.time() - self.started_at
+        rate = done / elapsed if elapsed else 0.0
+        line = f"{done}/{self.total}" if self.total else f"{done}"
+        line += f" articles, {rate:.2f}/s, {self.metrics.get('downloaded_bytes') / 1048576:.1f} MB"
+        if self.total and rate and not final:
+            line += f", ETA {(self.total - done) / rate:.0f}s"
+        sys.stderr.write("\r" + line + ("\n" if final else ""))
+        sys.stderr.flush()
+
+
+class RetryableError(Exception):
+    """可重试的错误（如下载不完整）"""
+
+
+class ThrottledError(RetryableError):
+    """站点在限流（如微信验证页），放慢后重试，不计入熔断"""
+
+
+class PermanentDownloadError(Exception):
+    """服务器明确拒绝（如 404），重新运行也下载不到，不必留占位等下次重试"""
+
+
+class ArticleParseError(Exception):
+    """页面中找不到正文（如文章已删除），流水线中记为失败，crawl_single 只打印提示"""
+
+
+class DeadlineExceeded(Exception):
+    """超过文章的处理时限，不再重试"""
+
+
+class Deadline:
+    """单篇文章的处理时限，基于 time.monotonic，可跨线程共享"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded")
+
+    def timeout(self, value):
+        """单次请求的超时：不超过剩余时间，已到期时抛出 DeadlineExceeded"""
+        self.check()
+        return min(value, self.remaining())
+
+
+_deadline_local = threading.local()
+
+
+def current_deadline():
+    """当前线程正在处理的文章的时限，没有时返回 None"""
+    return getattr(_deadline_local, "deadline", None)
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """在当前线程内设置时限；下载线程池、对冲请求会把它带到各自的线程"""
+    previous = current_deadline()
+    _deadline_local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _deadline_local.deadline = previous
+
+
+class CircuitOpenError(Exception):
+    """host 熔断中，直接失败"""
+
+
+class CircuitBreaker:
+    """
+    单个 host 的熔断器：连续 threshold 次可重试错误后打开，cooldown 秒内直接失败；
+    冷却结束后放行一次试探请求，成功则关闭，失败则重新打开。
+    """
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self, host):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.cooldown or self.probing:
+                raise CircuitOpenError(f"Circuit open for {host}")
+            self.probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self.probing = False
+
+    def release_probe(self):
+        """请求因本地原因失败、不能说明 host 是否可用：状态不变，下次请求可以重新试探"""
+        with self._lock:
+            self.probing = False
+
+
+class RetryPolicy:
+    """
+    统一重试策略：超时、连接中断、5xx、429 可重试，其余 4xx 等直接失败。
+    退避时间指数增长并加随机抖动，429/503 带 Retry-After 时以其为准；
+    每个 host 一个熔断器，host 明显不可用时快速失败，不再占用工作线程。
+    限流信号（429/503、验证页）说明 host 可用只是要求放慢，只等待重试，不计入熔断。
+    """
+    RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+    RETRY_EXCEPTIONS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError, RetryableError)
+
+    def __init__(self, max_retries=10, base_delay=0.5, max_delay=30,
+                 breaker_threshold=5, breaker_cooldown=30):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, host):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+            return self._breakers[host]
+
+    def is_retryable(self, exc):
+        if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+            return exc.response.status_code in self.RETRY_STATUS
+        return isinstance(exc, self.RETRY_EXCEPTIONS)
+
+    def is_permanent(self, exc):
+        """服务器返回了不可重试的状态码（如 404、410）"""
+        return (isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None
+                and exc.response.status_code not in self.RETRY_STATUS)
+
+    def is_throttled(self, exc):
+        if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+            return exc.response.status_code in THROTTLE_STATUS
+        return isinstance(exc, ThrottledError)
+
+    def retry_after(self, exc):
+        resp = getattr(exc, "response", None)
+        value = resp.headers.get("Retry-After") if resp is not None else None
+        if not value:
+            return None
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, exc):
+        retry_after = self.retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, url, func, metrics=None):
+        """执行 func(attempt)，按策略重试；不可重试或次数用尽时抛出最后一次的异常"""
+        host = urlparse(url).netloc
+        breaker = self.breaker(host)
+        deadline = current_deadline()
+        for attempt in range(self.max_retries):
+            if deadline is not None:
+                deadline.check()
+            breaker.before_call(host)
+            try:
+                result = func(attempt)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # 只有 host 确实返回了响应（如 404）才说明它可用；本地错误、超出时限等不改变熔断状态
+                    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+                        breaker.record_success()
+                    else:
+                        breaker.release_probe()
+                    raise
+                if self.is_throttled(e):
+                    # 限速器已按 slot.throttled 减速，这里只等待
+                    breaker.release_probe()
+                    if metrics is not None:
+                        metrics.incr("throttle_retries")
+                else:
+                    breaker.record_failure()
+                if attempt + 1 >= self.max_retries:
+                    raise
+                delay = self.delay(attempt, e)
+                if deadline is not None:
+                    delay = min(delay, max(0, deadline.remaining()))
+                if metrics is not None:
+                    metrics.incr("retries")
+                logger.info(f"Retry {attempt+1}/{self.max_retries} for {url} in {delay:.1f}s ({e})")
+                time.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+
+
+_hedge_local = threading.local()
+
+
+class HedgeTimer:
+    """一次请求的计时，从 mark()（取得限速令牌、即将发出）开始，排队等令牌的时间不算"""
+    def __init__(self):
+        self.start = None
+        self.sent = threading.Event()
+
+    def mark(self):
+        if self.start is None:
+            self.start = time.perf_counter()
+            self.sent.set()
+
+
+def mark_request_sent():
+    """请求即将发出时调用（见 request_slot），对冲的延迟统计和等待从这里开始"""
+    timer = getattr(_hedge_local, "timer", None)
+    if timer is not None:
+        timer.mark()
+
+
+class HedgePolicy:
+    """
+    对冲请求：请求发出后超过同一 host 最近延迟的 percentile 分位数仍未返回时，再发一个相同的请求，先成功的为准。
+    样本少于 min_samples 时不对冲；对冲请求最多占全部请求的 max_ratio，避免 host 变慢时放大负载。
+    慢的那个请求不会中断，结果直接丢弃。延迟从 func 调用 mark_request_sent() 算起，不含限速等待。
+    """
+    def __init__(self, percentile=95, min_samples=20, window=200, max_ratio=0.1, min_delay=0.05, workers=32):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+        self._latencies = {}
+        self._calls = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def observe(self, host, seconds):
+        with self._lock:
+            self._latencies.setdefault(host, deque(maxlen=self.window)).append(seconds)
+
+    def delay(self, host):
+        """发出对冲请求前的等待时间，样本不足时返回 None"""
+        with self._lock:
+            samples = sorted(self._latencies.get(host, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay, samples[index])
+
+    def _take_budget(self):
+        with self._lock:
+            if self._hedges >= self.max_ratio * self._calls:
+                return False
+            self._hedges += 1
+            return True
+
+    def call(self, url, func, metrics=None):
+        """执行一次请求 func()，必要时对冲；两个都失败时抛出先失败的异常"""
+        host = urlparse(url).netloc
+        delay = self.delay(host)
+        deadline = current_deadline()
+        with self._lock:
+            self._calls += 1
+
+        def run(timer):
+            _hedge_local.timer = timer
+            try:
+                with deadline_scope(deadline):
+                    start = time.perf_counter()
+                    result = func()
+                    self.observe(host, time.perf_counter() - (timer.start or start))
+                    return result
+            finally:
+                _hedge_local.timer = None
+                timer.sent.set()
+
+        if delay is None:
+            return run(HedgeTimer())
+        timer = HedgeTimer()
+        primary = self.executor.submit(run, timer)
+        # 主请求还在限速器排队时不对冲，发出后才开始计时
+        timer.sent.wait()
+        elapsed = time.perf_counter() - timer.start if timer.start is not None else 0
+        done, _ = wait([primary], timeout=max(0, delay - elapsed))
+        if done or not self._take_budget():
+            return primary.result()
+        backup = self.executor.submit(run, HedgeTimer())
+        if metrics is not None:
+            metrics.incr("hedged_requests")
+        pending, error = [primary, backup], None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future.exception() is None:
+                    if future is backup and metrics is not None:
+                        metrics.incr("hedge_wins")
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+
+class ProxyEntry:
+    """代理池中的一项：url 为 None 表示直连；延迟和错误率用指数滑动平均"""
+    def __init__(self, url):
+        self.url = url
+        self.name = self.display_name(url)
+        self.proxies = {"http": url, "https": url} if url else {}
+        self.latency = None
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    @staticmethod
+    def display_name(url):
+        """统计中隐藏用户名密码"""
+        if not url:
+            return "direct"
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.hostname}:{parsed.port}" if parsed.port else f"{parsed.scheme}://{parsed.hostname}"
+
+    def cost(self, default_latency):
+        """越小越优先：延迟 × 错误惩罚 × 并发中的请求数"""
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (1 + 4 * self.error_rate) * (1 + self.inflight)
+
+
+# 未传 proxy 时使用的本地代理；只有保持默认值时环境变量 XMLTOMD_PROXIES 才生效
+DEFAULT_PROXY = "http://127.0.0.1:7890"
+
+
+class ProxyPool:
+    """
+    代理池：每次请求用"二选一"挑选代价更低的健康代理，分散流量。
+    每个代理按延迟和错误率打分，错误率超过 max_error_rate 或平均延迟超过 max_latency 时
+    移出轮换 cooldown 秒，之后重新放入试探；全部不健康时仍选代价最低的一个，不会无代理可用。
+    配置项写 "direct"（或 none）表示直连。
+    """
+    ENV_VAR = "XMLTOMD_PROXIES"
+    DIRECT = ("", "direct", "none")
+    # 这些异常说明代理本身有问题；HTTP 4xx 等由源站返回的错误不计入代理健康度
+    PROXY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+    def __init__(self, proxies=None, max_error_rate=0.5, max_latency=10.0, cooldown=60,
+                 min_samples=5, alpha=0.3):
+        urls = [None if (p or "").strip().lower() in self.DIRECT else p.strip() for p in (proxies or [None])]
+        self.entries = [ProxyEntry(url) for url in dict.fromkeys(urls)]
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.cooldown = cooldown
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, text):
+        """按行或逗号分隔，# 开头为注释"""
+        items = []
+        for line in text.splitlines():
+            line = line.split("#", 1)[0]
+            items.extend(p.strip() for p in line.split(",") if p.strip())
+        return items
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(cls.parse(f.read()), **kwargs)
+
+    @classmethod
+    def from_env(cls, var=None, **kwargs):
+        """环境变量未设置时返回 None"""
+        value = os.environ.get(var or cls.ENV_VAR)
+        return cls(cls.parse(value), **kwargs) if value else None
+
+    def healthy(self, now):
+        return [e for e in self.entries if e.ejected_until <= now]
+
+    def choose(self):
+        """随机取两个健康代理，返回代价低的一个"""
+        with self._lock:
+            return self._choose()
+
+    def _choose(self):
+        candidates = self.healthy(time.time()) or self.entries
+        known = [e.latency for e in candidates if e.latency is not None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda e: e.cost(default_latency))
+
+    def acquire(self):
+        """选出代理并计入并发数，用完必须 release"""
+        with self._lock:
+            entry = self._choose()
+            entry.inflight += 1
+            return entry
+
+    def release(self, entry, ok, seconds):
+        with self._lock:
+            entry.inflight -= 1
+            entry.requests += 1
+            entry.total_seconds += seconds
+            if not ok:
+                entry.failures += 1
+            a = self.alpha
+            entry.latency = seconds if entry.latency is None else (1 - a) * entry.latency + a * seconds
+            entry.error_rate = (1 - a) * entry.error_rate + a * (0.0 if ok else 1.0)
+            if len(self.entries) > 1 and entry.requests >= self.min_samples and entry.ejected_until <= time.time() \
+                    and (entry.error_rate > self.max_error_rate or entry.latency > self.max_latency):
+                entry.ejected_until = time.time() + self.cooldown
+                entry.ejections += 1
+                # 冷却后重新试探，历史分数减半，避免一次恢复请求不足以放回
+                entry.error_rate /= 2
+                entry.latency /= 2
+                logger.warning(f"Proxy {entry.name} taken out of rotation for {self.cooldown}s "
+                               f"(error rate {entry.error_rate * 2:.0%}, latency {entry.latency * 2:.2f}s)")
+
+    @contextmanager
+    def use(self, slot=None):
+        """
+        with pool.use() as proxies: 发请求；结束后把耗时和是否为代理错误反馈给池。
+        传入 RateSlot 且调用过 slot.mark() 时按首字节耗时计分，大文件的传输时间不算进代理延迟。
+        """
+        entry = self.acquire()
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield entry.proxies
+        except self.PROXY_ERRORS:
+            ok = False
+            raise
+        finally:
+            seconds = slot.seconds if slot is not None and slot.seconds is not None else None
+            self.release(entry, ok, time.perf_counter() - start if seconds is None else seconds)
+
+    def stats(self):
+        with self._lock:
+            return {e.name: {"requests": e.requests, "failures": e.failures,
+                             "avg_seconds": round(e.total_seconds / e.requests, 4) if e.requests else 0.0,
+                             "latency_ewma": round(e.latency or 0.0, 4), "error_rate": round(e.error_rate, 4),
+                             "ejections": e.ejections}
+                    for e in self.entries}
+
+
+# 微信风控验证页的特征文字，出现即视为被限流
+VERIFICATION_MARKERS = ("环境异常", "完成验证后即可继续访问")
+THROTTLE_STATUS = {429, 503}
+
+
+class RateSlot:
+    """一次限速请求：调用方设置 throttled；mark() 记下首字节耗时，流式下载时不把正文传输算进延迟"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.waited = 0.0
+        self.throttled = False
+        self.seconds = None
+
+    def mark(self):
+        if self.seconds is None:
+            self.seconds = time.perf_counter() - self.start
+
+
+class TokenBucket:
+    """
+    单个 host 的令牌桶，速率按 AIMD 调整：
+    收到第一次限流信号前为慢启动，每个正常响应加 increase（速率约每秒翻倍）；之后正常响应每秒约加 increase，收到限流信号时乘以 decrease（每个 1/rate 且至少 1 秒内只降一次，
+    避免同一波并发请求把速率连续压到底）。延迟超过平均值 latency_factor 倍
+    且超过 SPIKE_MIN_SECONDS 也视为限流信号（几十毫秒级的抖动不算）。
+    """
+    SPIKE_MIN_SECONDS = 0.5
+
+    def __init__(self, rate, min_rate, max_rate, increase, decrease, burst, latency_factor):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.latency_factor = latency_factor
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_decrease = 0.0
+        self.slow_start = True
+        self.latency = None
+        self.samples = 0
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """取一个令牌，返回等待的秒数；当前文章的时限内等不到令牌时抛出 DeadlineExceeded"""
+        waited = 0.0
+        deadline = current_deadline()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and wait >= deadline.remaining():
+                raise DeadlineExceeded(f"Deadline of {deadline.seconds}s exceeded waiting for rate limit")
+            time.sleep(wait)
+            waited += wait
+
+    def feedback(self, seconds, throttled):
+        with self._lock:
+            self.requests += 1
+            if not throttled and self.samples >= 5 and seconds > max(self.latency_factor * self.latency,
+                                                                     self.SPIKE_MIN_SECONDS):
+                throttled = True
+            if throttled:
+                self.throttled += 1
+                self.slow_start = False
+                now = time.monotonic()
+                if now - self.last_decrease >= max(1.0, 1 / self.rate):
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.last_decrease = now
+                return throttled
+            step = self.increase if self.slow_start else self.increase / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+            self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+            self.samples += 1
+            return throttled
+
+
+class RateLimiter:
+    """
+    按 host 自适应限速：每个 host 一个 AIMD 令牌桶，从 initial_rate（请求/秒）开始，
+    响应正常时逐步提速到 max_rate，遇到 429/503、验证页或延迟突增时减速，尽量贴着站点允许的上限跑。
+    host_rates 可为个别 host 指定 (initial_rate, max_rate)，如图片 CDN。
+    默认起始速率和突发量足够 8 个并发工作线程满速运行，只在站点发出限流信号后才真正放慢；
+    微信图片 CDN 默认使用更高的速率。
+    """
+    DEFAULT_HOST_RATES = {host: (50.0, 200.0) for host in WECHAT_IMAGE_HOSTS}
+
+    def __init__(self, initial_rate=20.0, min_rate=0.2, max_rate=100.0, increase=1.0, decrease=0.5,
+                 burst=8, latency_factor=4.0, host_rates=None):
+        self.defaults = dict(rate=initial_rate, min_rate=min_rate, max_rate=max_rate, increase=increase,
+                             decrease=decrease, burst=burst, latency_factor=latency_factor)
+        self.host_rates = dict(self.DEFAULT_HOST_RATES, **(host_rates or {}))
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                options = dict(self.defaults)
+                if host in self.host_rates:
+                    options["rate"], options["max_rate"] = self.host_rates[host]
+                bucket = self._buckets[host] = TokenBucket(**options)
+            return bucket
+
+    @contextmanager
+    def limit(self, url):
+        """
+        with limiter.limit(url) as slot: 发请求并设置 slot.throttled。
+        超时算作限流信号；其他异常且未标记限流时不计入（连接失败等不代表站点在限流）。
+        """
+        bucket = self.bucket(urlparse(url).netloc)
+        slot = RateSlot()
+        slot.waited = bucket.take()
+        slot.start = time.perf_counter()
+        completed = False
+        try:
+            yield slot
+            completed = True
+        except requests.exceptions.Timeout:
+            slot.throttled = True
+            raise
+        finally:
+            if completed or slot.throttled:
+                slot.mark()
+                slot.throttled = bucket.feedback(slot.seconds, slot.throttled)
+
+    def stats(self):
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {host: {"rate": round(b.rate, 3), "requests": b.requests, "throttled": b.throttled}
+                for host, b in buckets.items()}
+
+
+def is_verification_page(text):
+    return any(marker in text for marker in VERIFICATION_MARKERS)
+
+
+_STOP = object()
+
+
+def parse_shard(value):
+    """"i/n" 或 (i, n) 转为 (i, n)，i 从 0 开始；None 表示不分片"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        index, sep, count = value.partition("/")
+        if not sep or not index.strip().isdigit() or not count.strip().isdigit():
+            raise ValueError(f"Invalid shard {value!r}, expected i/n")
+        value = (index, count)
+    index, count = int(value[0]), int(value[1])
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {index}/{count}, expected 0 <= i < n")
+    return index, count
+
+
+def shard_for(short_id, count):
+    """短 ID（generate_short_id 的结果）所属的分片，各节点计算结果一致"""
+    return int(short_id, 16) % count
+
+
+class Pipeline:
+    """
+    分阶段流水线：相邻阶段之间用有界队列连接，每个阶段有独立的工作线程数，
+    网络阶段与 CPU 阶段可以同时运行。队列满时上游阻塞（背压），内存占用有界。
+    stages: [(name, func, workers)]，func 接收上一阶段的结果，返回 None 表示丢弃。
+    """
+    def __init__(self, stages, queue_size=16):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        """items 由调用线程逐个放入第一个队列，返回 {key: 错误信息}"""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        stage_threads = []
+        for i, (name, func, workers) in enumerate(self.stages):
+            out_q = queues[i + 1] if i + 1 < len(queues) else None
+            threads = [threading.Thread(target=self._work, args=(name, func, queues[i], out_q),
+                                        name=f"{name}-{n}", daemon=True)
+                       for n in range(max(1, workers))]
+            for t in threads:
+                t.start()
+            stage_threads.append(threads)
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # 逐级关闭：上一阶段全部退出后再通知下一阶段
+            for q, threads in zip(queues, stage_threads):
+                for _ in threads:
+                    q.put(_STOP)
+                for t in threads:
+                    t.join()
+        return self.errors
+
+    def _work(self, name, func, in_q, out_q):
+        while True:
+            item = in_q.get()
+            if item is _STOP:
+                return
+            try:
+                result = func(item)
+            except Exception:
+                with self._lock:
+                    self.errors[item.get("key")] = f"[{name}] {traceback.format_exc()}"
+                continue
+            if result is not None and out_q is not None:
+                out_q.put(result)
+
+
 class BaseMarkdownCrawler:
     """
     公共基类：提供下载、ID 生成、保存 markdown、图片目录管理等功能。
+    子类通过 STAGES 声明文章处理阶段，每个阶段对应一个 stage_<name> 方法。
     """
-    def __init__(self, blog_root=".", download_images=True, max_retries=10):
+    STAGES = ()
+
+    # 可与其他爬虫共用的组件（见 shared 参数）
+    SHARED_COMPONENTS = ("metrics", "proxy_pool", "retry_policy", "asset_store", "http_cache", "manifest",
+                         "search_index", "rate_limiter", "asset_processor")
+
+    def __init__(self, blog_root=".", download_images=True, max_retries=10,
+                 max_download_workers=8, per_host_limit=4, stage_workers=None, queue_size=16,
+                 dedupe_assets=True, incremental=True, http_cache=None, retry_policy=None,
+                 proxy=DEFAULT_PROXY, verbose=False, progress=False, metrics_dir=None,
+                 asset_workers=4, webp=False, max_image_dimension=None, thumbnail_size=480,
+                 search_index=True, proxy_file=None, rate_limit=True, article_timeout=None, hedge=False,
+                 shard=None, shared=None):
         self.blog_root = blog_root
+        # 多台机器分工：shard="i/n" 时只处理短 ID 哈希落在第 i 片（从 0 开始）的文章，合并见 merge_shards
+        self.shard = parse_shard(shard)
+        # 各阶段工作线程数，如 {"fetch": 4, "assets": 4}，未指定的阶段为 1
+        self.stage_workers = dict(stage_workers or {})
+        self.queue_size = queue_size
+        self.metrics_dir = metrics_dir or os.path.join(blog_root, ".metrics")
+        self.progress = progress
+        self._progress = None
+        if verbose:
+            enable_verbose_logging()
+        self.proxy = proxy
         self.download_images = download_images
         self.max_retries = max_retries
         self.posts_dir = os.path.join(blog_root, "_posts")
@@ -51,133 +1750,707 @@ class BaseMarkdownCrawler:
         os.makedirs(self.posts_dir, exist_ok=True)
         os.makedirs(self.images_dir, exist_ok=True)
 
-        self.session = requests.Session()
-        self.session.headers.update({
+        if shared is not None:
+            # 共用另一个爬虫（同一 blog_root）的指标、清单、图片仓库、代理池、限速器等，
+            # 不再各建一份数据库连接和线程池；相关参数以 shared 创建时的为准
+            for name in self.SHARED_COMPONENTS:
+                setattr(self, name, getattr(shared, name))
+        else:
+            # 各阶段耗时和计数器，crawl / crawl_batch 结束时写入 metrics_dir（默认 blog_root/.metrics）
+            self.metrics = Metrics()
+            # 代理池：proxy_file > 显式传入的 proxy（地址、地址列表或 ProxyPool，None 为直连）
+            # > 环境变量 XMLTOMD_PROXIES > 默认代理
+            if isinstance(proxy, ProxyPool):
+                self.proxy_pool = proxy
+            elif proxy_file:
+                self.proxy_pool = ProxyPool.from_file(proxy_file)
+            else:
+                self.proxy_pool = ((ProxyPool.from_env() if proxy == DEFAULT_PROXY else None)
+                                   or ProxyPool([proxy] if isinstance(proxy, str) or proxy is None else list(proxy)))
+            self.retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+
+            # 图片按内容去重，仓库放在下划线目录，Jekyll 不会发布
+            self.asset_store = AssetStore(os.path.join(blog_root, "_assets")) if dedupe_assets else None
+
+            # HTTP 缓存：传入 True 使用 blog_root/.cache/http，也可传入自定义的 HttpCache
+            if http_cache is True:
+                http_cache = HttpCache(os.path.join(blog_root, ".cache", "http"))
+            self.http_cache = http_cache or None
+
+            # 增量清单：未变化的文章直接跳过
+            output_options = {"download_images": download_images, "webp": webp,
+                              "max_image_dimension": max_image_dimension, "thumbnail_size": thumbnail_size}
+            self.manifest = (Manifest(os.path.join(blog_root, ".manifest.sqlite"), output_options)
+                             if incremental else None)
+
+            # 站内搜索索引：保存文章时更新，crawl / crawl_batch 结束时写出到 blog_root/search
+            self.search_index = SearchIndex(os.path.join(blog_root, "search"),
+                                            os.path.join(blog_root, ".search.sqlite")) if search_index else None
+
+            # 按 host 自适应限速：True 使用默认参数，也可传入自定义的 RateLimiter，False 关闭
+            self.rate_limiter = RateLimiter() if rate_limit is True else (rate_limit or None)
+
+            # 下载完成后修正扩展名，可选转 WebP、限制尺寸、生成封面缩略图
+            self.asset_processor = AssetProcessor(workers=asset_workers, webp=webp,
+                                                  max_dimension=max_image_dimension,
+                                                  thumbnail_size=thumbnail_size, store=self.asset_store)
+
+        # 离线模式（reprocess）：不发任何请求，图片引用本地已有的文件
+        self.offline = False
+
+        # 两阶段模式：planning() 期间图片只登记到清单，由 execute_plan 统一下载
+        self.asset_plan = None
+        self.plan_path = os.path.join(blog_root, ".asset-plan.jsonl")
+
+        # 单篇文章的总时限（秒）：到期后取消未完成的下载和重试，文章记为失败，None 不限制
+        self.article_timeout = article_timeout
+        # 对冲请求：True 使用默认参数，也可传入自定义的 HedgePolicy
+        self.hedge = HedgePolicy() if hedge is True else (hedge or None)
+
+        # requests.Session 不保证线程安全，每个线程各用一个
+        self._local = threading.local()
+        self.downloader = DownloadManager(self.download_asset, max_workers=max_download_workers,
+                                          per_host_limit=per_host_limit)
+        # 下载响应的 Content-Type（按规范化地址），处理图片时取出；下载失败或两阶段模式下随即删除，长期运行不会累积
+        self.content_types = {}
+
+    def new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
                           "AppleWebKit/537.36 (KHTML, like Gecko) "
                           "Chrome/114.0 Safari/537.36"
         })
+        return session
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self.new_session()
+        return session
 
     def generate_short_id(self, text):
         md5_val = hashlib.md5(text.encode("utf-8")).hexdigest()
         return md5_val[:8]
 
+    def in_shard(self, short_id):
+        return self.shard is None or shard_for(short_id, self.shard[1]) == self.shard[0]
+
+    @contextmanager
+    def request_slot(self, url):
+        """限速后选代理：with self.request_slot(url) as (slot, proxies)，限流信号写到 slot.throttled"""
+        limiter = self.rate_limiter
+        slot = None
+        try:
+            with (limiter.limit(url) if limiter else nullcontext(RateSlot())) as slot, \
+                    self.proxy_pool.use(slot) as proxies:
+                mark_request_sent()
+                yield slot, proxies
+        finally:
+            if slot is not None:
+                self.metrics.incr("rate_limit_wait_seconds", round(slot.waited, 3))
+                if slot.throttled:
+                    self.metrics.incr("throttled")
+
     def get_proxies(self):
-        ip = "http://127.0.0.1:7890"
-        return {"http": ip, "https": ip}
+        """从代理池选一个代理；不反馈健康度，发请求请用 proxy_pool.use()"""
+        return self.proxy_pool.choose().proxies
 
 
     def fetch_article(self, url, timeout=10):
-        for attempt in range(self.max_retries):
-            try:
-                proxies = self.get_proxies()
-                print("Fetching %s with proxy %s" % (url, proxies))
-                resp = self.session.get(url, proxies=proxies, timeout=timeout)
-                resp.raise_for_status()
-                return resp.text
-            except Exception as e:
-                print(f"Retry {attempt+1}/{self.max_retries} for {url} ({e})")
-                time.sleep(1)
-        raise Exception(f"Failed to fetch {url} after {self.max_retries} retries")
+        """抓取页面，按重试策略重试；开启对冲时每次尝试都可能对冲，超时不超过文章剩余时限"""
+        cache = self.http_cache
+        entry = cache.lookup(url) if cache else None
+        if entry and entry["fresh"]:
+            self.metrics.incr("cache_hits")
+            return cache.read_text(entry)
 
-    def download_file(self, url, dest_path):
-        """下载文件，失败自动重试"""
-        for attempt in range(self.max_retries):
-            try:
-                proxies = self.get_proxies()
-                resp = self.session.get(url, proxies=proxies, timeout=10)
+        def attempt_fetch(attempt):
+            self.metrics.incr("requests")
+            with self.request_slot(url) as (slot, proxies):
+                logger.info("Fetching %s with proxy %s" % (url, proxies))
+                deadline = current_deadline()
+                resp = self.session.get(url, proxies=proxies,
+                                        timeout=deadline.timeout(timeout) if deadline else timeout,
+                                        headers=cache.conditional_headers(entry) if cache else None)
+                verification = resp.status_code == 200 and is_verification_page(resp.text)
+                slot.throttled = verification or resp.status_code in THROTTLE_STATUS
+            if verification:
+                # 验证页不缓存，放慢速度后重试
+                raise ThrottledError("Verification page")
+            if resp.status_code == 304 and entry:
+                cache.revalidated(entry)
+                self.metrics.incr("cache_hits")
+                return cache.read_text(entry)
+            resp.raise_for_status()
+            self.metrics.incr("downloaded_bytes", len(resp.content))
+            if cache:
+                cache.store(url, resp.headers, resp.content, resp.encoding)
+            return resp.text
+
+        attempt = attempt_fetch
+        if self.hedge is not None:
+            attempt = lambda n: self.hedge.call(url, lambda: attempt_fetch(n), self.metrics)
+        try:
+            return self.retry_policy.call(url, attempt, self.metrics)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to fetch {url} ({e})") from e
+
+    def download_file(self, url, dest_path, chunk_size=64 * 1024):
+        """
+        下载文件，按重试策略自动重试。
+        分块写入 <dest>.part，校验 Content-Length 后原子重命名，中断不会留下残缺的目标文件；
+        重试时若服务器支持 Range 则从已下载的位置续传。
+        暂时性失败返回 False；服务器明确拒绝（如 404）时抛出 PermanentDownloadError。
+        """
+        cache = self.http_cache
+        entry = cache.lookup(url) if cache else None
+        part_path = dest_path + ".part"
+        if entry and entry["fresh"]:
+            self.metrics.incr("cache_hits")
+            shutil.copyfile(entry["body_path"], part_path)
+            os.replace(part_path, dest_path)
+            return True
+        # 上次运行残留的 .part 来源不明，不续传
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        state = {"validator": None}
+        deadline = current_deadline()
+
+        def attempt_download(attempt):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = cache.conditional_headers(entry) if cache and not offset else {}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                if state["validator"]:
+                    headers["If-Range"] = state["validator"]
+            self.metrics.incr("requests")
+            with self.request_slot(url) as (slot, proxies), \
+                    self.session.get(url, proxies=proxies, timeout=deadline.timeout(10) if deadline else 10,
+                                     headers=headers, stream=True) as resp:
+                slot.mark()
+                slot.throttled = resp.status_code in THROTTLE_STATUS
+                if resp.status_code == 304 and entry:
+                    cache.revalidated(entry)
+                    self.metrics.incr("cache_hits")
+                    shutil.copyfile(entry["body_path"], part_path)
+                    os.replace(part_path, dest_path)
+                    return
+                if resp.status_code == 416:
+                    os.remove(part_path)
+                    raise RetryableError("Range not satisfiable, restarting")
                 resp.raise_for_status()
-                with open(dest_path, "wb") as f:
-                    f.write(resp.content)
-                return True
-            except Exception as e:
-                print(f"Retry {attempt+1}/{self.max_retries} for {url} ({e})")
-                time.sleep(1)
-        print(f"Failed to download after {self.max_retries} retries: {url}")
-        return False
+                if resp.status_code == 206 and not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                    os.remove(part_path)
+                    raise RetryableError("Unexpected Content-Range, restarting")
+                state["validator"] = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                self.content_types[canonical_asset_url(url)] = resp.headers.get("Content-Type")
+                expected = self._expected_size(resp)
+                mode = "ab" if resp.status_code == 206 else "wb"
+                with open(part_path, mode) as f:
+                    for chunk in resp.iter_content(chunk_size):
+                        if deadline is not None:
+                            deadline.check()
+                        f.write(chunk)
+                        self.metrics.incr("downloaded_bytes", len(chunk))
+                headers = resp.headers
+            size = os.path.getsize(part_path)
+            if expected is not None and size != expected:
+                raise RetryableError(f"Incomplete download: {size}/{expected} bytes")
+            os.replace(part_path, dest_path)
+            if cache:
+                cache.store_file(url, headers, dest_path)
+
+        try:
+            self.retry_policy.call(url, attempt_download, self.metrics)
+            return True
+        except Exception as e:
+            self.content_types.pop(canonical_asset_url(url), None)
+            self.metrics.incr("download_failures")
+            logger.warning(f"Failed to download {url} ({e})")
+            if self.retry_policy.is_permanent(e):
+                raise PermanentDownloadError(f"{url} ({e})") from e
+            return False
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    def _expected_size(self, resp):
+        """根据响应头推算完整文件大小；经过压缩编码时无法校验，返回 None"""
+        if resp.headers.get("Content-Encoding", "identity") != "identity":
+            return None
+        if resp.status_code == 206:
+            m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", resp.headers.get("Content-Range", ""))
+            if not m:
+                return None
+            return int(m.group(2)) if m.group(2) != "*" else None
+        length = resp.headers.get("Content-Length")
+        return int(length) if length and length.isdigit() else None
+
+    def download_asset(self, url, dest_path):
+        """
+        下载图片：仓库按规范化地址去重，已知地址不再请求，相同内容只存一份；
+        请求使用 asset_request_url，非微信 CDN 的地址不做改动。
+        """
+        key = canonical_asset_url(url)
+        url = asset_request_url(url)
+        store = self.asset_store
+        if store is None:
+            ok = self.download_file(url, dest_path)
+            if ok:
+                self.metrics.incr("images")
+            return ok
+        with store.url_lock(key):
+            digest = store.lookup(key)
+            if digest is None:
+                tmp_path = store.new_tmp_path()
+                ok = False
+                try:
+                    ok = self.download_file(url, tmp_path)
+                finally:
+                    if not ok and os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                if not ok:
+                    return False
+                digest = store.put(key, tmp_path)
+            else:
+                self.metrics.incr("images_deduplicated")
+        store.link(digest, dest_path)
+        self.metrics.incr("images")
+        return True
 
     def save_markdown(self, short_id, content, date):
         filename = f"{date}-{short_id}.md"
         filepath = os.path.join(self.posts_dir, filename)
+        # 内容没变就不重写，保持 mtime，jekyll build --incremental 才能跳过
+        if os.path.exists(filepath):
+            with open(filepath, "r", encoding="utf-8") as f:
+                if f.read() == content:
+                    logger.info(f"Unchanged: {filepath}")
+                    return filepath
         with open(filepath, "w", encoding="utf-8") as f:
             f.write(content)
-        print(f"Saved: {filepath}")
+        logger.info(f"Saved: {filepath}")
+        return filepath
+
+    def stage_write(self, ctx):
+        filepath = ctx["filepath"] = self.save_markdown(ctx["short_id"], ctx["markdown"], ctx["date"])
+        self.metrics.incr("articles_written")
+        if self.search_index is not None:
+            self.search_index.add_post(filepath, ctx["markdown"])
+        if self.manifest is not None:
+            self.manifest.record(ctx["source_id"], ctx.get("content_hash"), [filepath] + ctx.get("assets", []))
+        return ctx
+
+    def skip_unchanged(self, items, skipped):
+        """过滤清单中已是最新的文章，skipped 收集被跳过的 key"""
+        for ctx in items:
+            if self.manifest is not None and self.manifest.is_current(ctx["source_id"], ctx.get("content_hash")):
+                skipped.append(ctx["key"])
+                self.metrics.incr("articles_skipped")
+                continue
+            yield ctx
+
+    @property
+    def stage_seconds(self):
+        return self.metrics.stage_seconds
+
+    def timed_stage(self, name):
+        """
+        返回 stage_<name>，每次调用的耗时记入 metrics，失败计入 articles_failed。
+        设置了 article_timeout 时，文章进入第一个阶段开始计时，各阶段在该时限内运行，
+        到期后不再进入下一阶段（已完成转换的文章仍会写入）。
+        """
+        func = getattr(self, f"stage_{name}")
+
+        def run(ctx):
+            start = time.perf_counter()
+            if self.article_timeout and "deadline" not in ctx:
+                ctx["deadline"] = Deadline(self.article_timeout)
+            deadline = ctx.get("deadline")
+            try:
+                if deadline is not None and name != "write":
+                    deadline.check()
+                with deadline_scope(deadline):
+                    return func(ctx)
+            except Exception as e:
+                self.metrics.incr("articles_failed")
+                if isinstance(e, DeadlineExceeded):
+                    self.metrics.incr("deadline_exceeded")
+                raise
+            finally:
+                self.metrics.observe_stage(name, time.perf_counter() - start)
+        return run
+
+    def begin_run(self, total=None):
+        """crawl / crawl_batch 开始：按需启动进度输出"""
+        if self.progress:
+            self._progress = ProgressReporter(self.metrics, total).start()
 
-    def download_images_and_replace(self, soup_or_html, article_img_dir, article_id):
+    def end_run(self):
+        """crawl / crawl_batch 结束：停止进度输出，写出指标汇总"""
+        if self._progress is not None:
+            self._progress.stop()
+            self._progress = None
+        proxy_stats = self.proxy_pool.stats()
+        if len(proxy_stats) > 1:
+            for name, stat in proxy_stats.items():
+                print(f"Proxy {name}: {stat['requests']} requests, {stat['failures']} failed, "
+                      f"avg {stat['avg_seconds']:.2f}s, taken out {stat['ejections']} times")
+        self.flush_outputs()
+
+    def flush_outputs(self):
+        """写出搜索索引和运行指标；长期运行时（syncd.py）定期调用"""
+        if self.rate_limiter is not None:
+            self.metrics.set_labeled("host", "host", self.rate_limiter.stats())
+        self.metrics.set_labeled("proxy", "proxy", self.proxy_pool.stats())
+        if self.search_index is not None:
+            start = time.perf_counter()
+            self.search_index.sync_posts(self.posts_dir)
+            self.metrics.incr("search_shards_written", self.search_index.flush())
+            self.metrics.observe_stage("search_index", time.perf_counter() - start)
+        self.metrics.write(self.metrics_dir)
+
+    def run_stages(self, ctx, stages=None):
+        """在当前线程内依次执行全部阶段（或指定的阶段）"""
+        for name in stages or self.STAGES:
+            ctx = self.timed_stage(name)(ctx)
+            if ctx is None:
+                return None
+        return ctx
+
+    def run_pipeline(self, items, stage_workers=None):
+        """多篇文章走流水线，返回 {key: 错误信息}"""
+        workers = dict(self.stage_workers, **(stage_workers or {}))
+        stages = [(name, self.timed_stage(name), workers.get(name, 1)) for name in self.STAGES]
+        return Pipeline(stages, queue_size=self.queue_size).run(items)
+
+    def print_batch_summary(self, total, errors, skipped=()):
+        print(f"Crawled {total - len(errors) - len(skipped)}/{total} articles, "
+              f"{len(skipped)} unchanged, {len(errors)} failed")
+        for key, err in errors.items():
+            last_line = err.strip().splitlines()[-1]
+            print(f"  {key}: {last_line}")
+
+    def download_images_and_replace(self, soup_or_html, article_img_dir, article_id, outputs=None):
         """
         通用图片下载：支持 BeautifulSoup 或 HTML 字符串。
-        图片按 1.png, 2.png 命名，替换 src。
+        图片先按 1.png, 2.png 占位命名并立即替换 src，下载交给线程池并发执行；
+        全部下载完成后在处理线程池中识别真实格式（可选转码、缩放），再把 src 改成最终文件名。
+        outputs 不为 None 时追加最终的本地图片路径。图片目录在第一次下载前才创建。
+        data: URI 本身就是图片内容，保留原样，不下载。
         """
+        batch = self.downloader.batch()
+        pending = {}  # 占位文件名 -> (url, 本地路径)
+        plan = self.asset_plan
+
+        def register(img_url, idx):
+            if self.offline:
+                # 本地没有的图片也记下占位路径，之后联网运行时清单会重新处理这篇文章
+                filename = self.existing_image(article_img_dir, str(idx)) or f"{idx}.png"
+                if outputs is not None:
+                    outputs.append(os.path.join(article_img_dir, filename))
+                return filename
+            if plan is not None and self.download_images:
+                # 两阶段模式：按地址推测扩展名，登记到清单，不下载
+                filename = f"{idx}.{guess_image_extension(img_url)}"
+                local_path = os.path.join(article_img_dir, filename)
+                plan.add(img_url, local_path)
+                if outputs is not None:
+                    outputs.append(local_path)
+                return filename
+            filename = f"{idx}.png"
+            if self.download_images:
+                os.makedirs(article_img_dir, exist_ok=True)
+                local_path = os.path.join(article_img_dir, filename)
+                batch.add(img_url, local_path)
+                pending[filename] = (img_url, local_path)
+            return filename
+
         if isinstance(soup_or_html, (BeautifulSoup, bs4.element.Tag)):
+            tags = {}
             img_tags = soup_or_html.find_all("img")
             for idx, img in enumerate(img_tags, start=1):
-                os.makedirs(article_img_dir, exist_ok=True)
                 img_url = img.get("data-src") or img.get("src")
-                if not img_url:
+                if not img_url or img_url.startswith("data:"):
                     continue
-                filename = f"{idx}.png"
-                local_path = os.path.join(article_img_dir, filename)
-                if self.download_images:
-                    self.download_file(img_url, local_path)
+                filename = register(img_url, idx)
+                tags[filename] = img
                 img["src"] = f"/images/{article_id}/{filename}"
+            final = self.finalize_images(batch, pending, outputs)
+            for filename, new_name in final.items():
+                tags[filename]["src"] = f"/images/{article_id}/{new_name}"
             return soup_or_html
-        else:
-            # HTML 字符串处理（用于 XML 内容）
-            def repl(m):
-                os.makedirs(article_img_dir, exist_ok=True)
-                idx = repl.counter + 1
-                repl.counter += 1
-                img_url = m.group(1)
-                filename = f"{idx}.png"
-                local_path = os.path.join(article_img_dir, filename)
-                if self.download_images:
-                    self.download_file(img_url, local_path)
-                return f'src="/images/{article_id}/{filename}"'
-            repl.counter = 0
-            return re.sub(r'src=["\'](.*?)["\']', repl, soup_or_html)
+
+        # HTML 字符串处理（用于 XML 内容）
+        def repl(m):
+            if m.group(1).startswith("data:"):
+                return m.group(0)
+            repl.counter += 1
+            return f'src="/images/{article_id}/{register(m.group(1), repl.counter)}"'
+        repl.counter = 0
+        result = re.sub(r'src=["\'](.*?)["\']', repl, soup_or_html)
+        final = self.finalize_images(batch, pending, outputs)
+        if final:
+            prefix = re.escape(f'src="/images/{article_id}/')
+            result = re.sub(prefix + r'(\d+\.png)"',
+                            lambda m: f'src="/images/{article_id}/{final.get(m.group(1), m.group(1))}"', result)
+        return result
+
+    @staticmethod
+    def existing_image(directory, stem):
+        """目录中已下载的 <stem>.<扩展名>，没有时返回 None"""
+        if not os.path.isdir(directory):
+            return None
+        for name in sorted(os.listdir(directory)):
+            base, ext = os.path.splitext(name)
+            if base == stem and ext.lstrip(".") in CONTENT_TYPE_EXTENSIONS.values():
+                return name
+        return None
+
+    @contextmanager
+    def planning(self, path=None):
+        """
+        两阶段模式的第一阶段：with crawler.planning(): crawler.crawl()。
+        文章照常解析、转换和保存，图片只按规范化地址登记，退出时写出清单（默认 blog_root/.asset-plan.jsonl）。
+        """
+        plan = self.asset_plan = AssetPlan()
+        try:
+            yield plan
+        finally:
+            self.asset_plan = None
+            plan.write(path or self.plan_path)
+            print(f"Planned {len(plan)} unique assets for "
+                  f"{sum(len(e['targets']) for e in plan.assets.values())} image references")
+
+    def execute_plan(self, path=None, max_workers=32, per_host_limit=8):
+        """
+        第二阶段：按清单下载，每个地址只请求一次，再链接到其余目标路径。
+        目标已存在的跳过，中断后重新执行只补齐缺少的；外部工具下载过第一个目标时也只做链接。
+        返回失败的地址列表。
+        """
+        plan = AssetPlan.load(path or self.plan_path)
+        manager = DownloadManager(
+            lambda url, dest: self.download_planned(url, plan.assets[canonical_asset_url(url)]["targets"]),
+            max_workers=max_workers, per_host_limit=per_host_limit)
+        batch = manager.batch()
+        for entry in plan.assets.values():
+            batch.add(entry["url"], entry["targets"][0])
+        self.begin_run()
+        try:
+            failed = batch.wait()
+        finally:
+            manager.shutdown()
+            self.end_run()
+        print(f"Downloaded {len(plan) - len(failed)}/{len(plan)} assets, {len(failed)} failed")
+        return failed
+
+    def download_planned(self, url, targets):
+        """下载一个清单条目：已有任一目标时直接复用，否则下载到第一个缺少的目标"""
+        missing = [t for t in targets if not os.path.exists(t)]
+        if not missing:
+            return True
+        existing = next((t for t in targets if os.path.exists(t)), None)
+        for target in missing:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        if existing is None:
+            try:
+                if not self.download_asset(url, missing[0]):
+                    return False
+            finally:
+                # 清单模式不做格式识别，用不到 Content-Type
+                self.content_types.pop(canonical_asset_url(url), None)
+            existing = missing.pop(0)
+        for target in missing:
+            AssetStore.link_file(existing, target)
+            self.metrics.incr("images_deduplicated")
+        return True
+
+    def finalize_images(self, batch, pending, outputs=None):
+        """
+        等待下载完成并处理图片，返回 {占位文件名: 最终文件名}（只含文件名有变化的）。
+        暂时性失败的图片也把占位路径记入 outputs，文件不存在时清单不会把文章当作已完成，下次运行重新下载；
+        服务器明确拒绝的（如 404）重新运行也不会成功，不记占位。
+        """
+        failed = set(batch.wait())
+        futures = {}
+        for filename, (url, path) in pending.items():
+            key = canonical_asset_url(url)
+            content_type = self.content_types.pop(key, None)
+            if url not in failed and os.path.exists(path):
+                futures[filename] = self.asset_processor.submit(path, content_type, key)
+            elif outputs is not None and url not in batch.permanent:
+                outputs.append(path)
+        renamed = {}
+        for filename, future in futures.items():
+            path = pending[filename][1]
+            try:
+                path = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to process image {path} ({e})")
+            if outputs is not None:
+                outputs.append(path)
+            new_name = os.path.basename(path)
+            if new_name != filename:
+                renamed[filename] = new_name
+        return renamed
+
+
+# 微信页面 script 中的元数据
+CREATE_TIME_PATTERN = re.compile(r"createTime\s*=\s*'([\d\-: ]+)'")
+# album_info_list 中的每个对象，以及对象里的 key: 'value'
+ALBUM_OBJ_PATTERN = re.compile(r"\{\s*(.*?)\s*\}", re.S)
+ALBUM_FIELD_PATTERN = re.compile(r"(\w+):\s*'([^']*)'")
+# 其它 var name = "value" / htmlDecode("value") 形式的字段，如 nickname、msg_desc
+JS_VAR_PATTERN = re.compile(r"var\s+(\w+)\s*=\s*(?:htmlDecode\()?[\"']([^\"'\n]*)[\"']")
+
+
+@dataclass
+class WeChatMetadata:
+    """微信文章元数据，js_vars 中是页面脚本里的其它字符串变量"""
+    title: str = "Untitled"
+    date: str = ""
+    albums: list = field(default_factory=list)
+    thumbnail: str = "/images/default-post-thumbnail.png"
+    author: str = "胖胖不胖"
+    js_vars: dict = field(default_factory=dict)
+
+
+class WeChatMetadataExtractor:
+    """
+    一次遍历 h1/meta/script 节点提取全部元数据，每种节点交给对应的 on_<tag> 处理。
+    新增字段只需扩展处理函数，不会增加遍历次数。
+    """
+    TAGS = ("h1", "meta", "script")
+
+    def extract(self, soup):
+        meta = WeChatMetadata(date=datetime.now().strftime("%Y-%m-%d"))
+        seen = set()
+        for tag in soup.find_all(self.TAGS):
+            getattr(self, f"on_{tag.name}")(tag, meta, seen)
+        return meta
+
+    def on_h1(self, tag, meta, seen):
+        if "title" not in seen and "rich_media_title" in (tag.get("class") or []):
+            seen.add("title")
+            meta.title = tag.get_text(strip=True)
+
+    def on_meta(self, tag, meta, seen):
+        # 与 soup.find 一致：只看第一个匹配的 meta
+        if tag.get("property") == "og:image" and "thumbnail" not in seen:
+            seen.add("thumbnail")
+            if tag.get("content"):
+                meta.thumbnail = tag["content"]
+        elif tag.get("name") == "author" and "author" not in seen:
+            seen.add("author")
+            if tag.get("content"):
+                meta.author = tag["content"]
+
+    def on_script(self, tag, meta, seen):
+        js_string = tag.string
+        if not js_string:
+            return
+        if "createTime" in js_string:
+            m = CREATE_TIME_PATTERN.search(js_string)
+            if m:
+                meta.date = m.group(1).split()[0]
+        if " album_info_list " in js_string:
+            for obj_match in ALBUM_OBJ_PATTERN.findall(js_string):
+                # 清洗值：替换 &amp;，去掉 *1 表达式影响
+                fields = {k: v.replace("&amp;", "&").strip() for k, v in ALBUM_FIELD_PATTERN.findall(obj_match)}
+                if "albumId" in fields and "title" in fields:
+                    meta.albums.append(fields["title"])
+        if "var " in js_string:
+            for name, value in JS_VAR_PATTERN.findall(js_string):
+                meta.js_vars.setdefault(name, value)
+
+
+def wechat_tag_wanted(name, attrs):
+    """微信页面中解析会用到的节点：标题、封面/作者 meta、script、正文 div"""
+    attrs = attrs or {}
+    if name == "script":
+        return True
+    if name == "meta":
+        return attrs.get("property") == "og:image" or attrs.get("name") == "author"
+    if name == "h1":
+        classes = attrs.get("class") or ""
+        if isinstance(classes, str):
+            classes = classes.split()
+        return "rich_media_title" in classes
+    if name == "div":
+        return attrs.get("id") == "js_content"
+    return False
+
+
+class WeChatStrainer(SoupStrainer):
+    """
+    只构建 wechat_tag_wanted 选中的节点及其子树，跳过页面其余部分。
+    bs4 < 4.13 通过可调用的 name(name, attrs) 过滤，新版本通过 allow_tag_creation。
+    """
+    def __init__(self):
+        super().__init__(wechat_tag_wanted)
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return wechat_tag_wanted(name, attrs)
 
 
 class WeChatArticleCrawler(BaseMarkdownCrawler):
     """保持原微信爬虫功能，继承公共逻辑"""
+    STAGES = ("fetch", "parse", "assets", "convert", "write")
+    ARTICLE_URL = "https://mp.weixin.qq.com/s/{pid}"
+
+    # reprocess 从归档读取页面，跳过 fetch
+    REPROCESS_STAGES = ("parse", "assets", "convert", "write")
+
+    def __init__(self, max_workers=1, parser="auto", parse_only=True, archive=True, **kwargs):
+        super().__init__(**kwargs)
+        # crawl_batch 中网络阶段（fetch、assets）的默认并发数
+        self.max_workers = max_workers
+        self.parser = self.resolve_parser(parser)
+        # 只解析标题、meta、script 和正文；需要 parse_category 等其它节点时设为 False。
+        # html5lib 不支持按需解析，会忽略此选项
+        self.parse_only = parse_only and self.parser != "html5lib"
+        self.metadata_extractor = WeChatMetadataExtractor()
+        # 抓到的原始页面压缩归档到 blog_root/.archive，修改转换规则后用 reprocess 离线重新生成
+        self.archive = PageArchive(os.path.join(self.blog_root, ".archive")) if archive else None
+
+    def resolve_parser(self, parser):
+        """返回第一个可用的解析器：指定的解析器 → lxml → html.parser"""
+        candidates = ([] if parser == "auto" else [parser]) + ["lxml", "html.parser"]
+        for name in candidates:
+            if builder_registry.lookup(name) is not None:
+                if parser not in ("auto", name):
+                    logger.warning(f"Parser {parser} not available, falling back to {name}")
+                return name
+        return "html.parser"
+
+    def make_soup(self, html):
+        if self.parse_only:
+            return BeautifulSoup(html, self.parser, parse_only=WeChatStrainer())
+        return BeautifulSoup(html, self.parser)
+
+    def extract_metadata(self, soup):
+        return self.metadata_extractor.extract(soup)
+
+    # 以下单字段方法保留兼容，批量处理请用 extract_metadata 一次取全
     def parse_title(self, soup):
-        tag = soup.find("h1", class_="rich_media_title")
-        return tag.get_text(strip=True) if tag else "Untitled"
+        return self.extract_metadata(soup).title
 
     def parse_date_and_cate(self, soup):
-        albums = []
-        date_string = datetime.now().strftime("%Y-%m-%d")
-        for s in soup.find_all("script"):
-            js_string = s.string
-            if js_string and "createTime" in js_string:
-                m = re.search(r"createTime\s*=\s*'([\d\-: ]+)'", js_string)
-                if m:
-                    date_string = m.group(1).split()[0]
-            if js_string and " album_info_list " in js_string:
-                # 匹配每个对象
-                obj_pattern = re.compile(r"\{\s*(.*?)\s*\}", re.S)
-                # 匹配 key: 'value'
-                field_pattern = re.compile(r"(\w+):\s*'([^']*)'")
-
-                for obj_match in obj_pattern.findall(js_string):
-                    fields = dict(field_pattern.findall(obj_match))
-                    # 清洗值：替换 &amp;，去掉 *1 表达式影响
-                    clean_fields = {}
-                    for k, v in fields.items():
-                        v = v.replace("&amp;", "&").strip()
-                        clean_fields[k] = v
-                    if "albumId" in clean_fields and "title" in clean_fields:
-                        albums.append(clean_fields["title"])
-
-                # print(albums)
-        return date_string, albums
+        meta = self.extract_metadata(soup)
+        return meta.date, meta.albums
 
     def parse_thumbnail_url(self, soup):
-        tag = soup.find("meta", {"property": "og:image"})
-        return tag["content"] if tag and tag.get("content") else "/images/default-post-thumbnail.png"
+        return self.extract_metadata(soup).thumbnail
 
     def parse_author(self, soup):
-        tag = soup.find("meta", {"name": "author"})
-        return tag["content"] if tag and tag.get("content") else "胖胖不胖"
+        return self.extract_metadata(soup).author
 
     def parse_category(self, soup):
         tags = []
@@ -219,7 +2492,8 @@ class WeChatArticleCrawler(BaseMarkdownCrawler):
         return content_div
 
     def html_to_markdown(self, soup):
-        return md(str(soup), heading_style="ATX", code_language_detection=True)
+        # 直接遍历已改写的正文节点，不再 str(soup) 后重新解析
+        return html_to_markdown(soup)
 
     def generate_front_matter(self, title, date, url, thumbnail, category, author):
         tags_yaml = "\n".join(f"    - {tag}" for tag in (category or ["Python"]))
@@ -228,50 +2502,557 @@ class WeChatArticleCrawler(BaseMarkdownCrawler):
             tags_yaml=tags_yaml, author=author, categories=(category[:1] or ["微信公众号"])[0]
         )
 
-    def crawl_single(self, url):
-        html = self.fetch_article(url)
-        soup = BeautifulSoup(html, "html.parser")
-        title = self.parse_title(soup)
-        date_string, category = self.parse_date_and_cate(soup)
-        thumb_url = self.parse_thumbnail_url(soup)
-        author = self.parse_author(soup)
+    def stage_fetch(self, ctx):
+        ctx["html"] = self.fetch_article(ctx["url"])
+        ctx["content_hash"] = hashlib.md5(ctx["html"].encode("utf-8")).hexdigest()
+        if self.archive is not None:
+            self.archive.put(ctx["url"], ctx["html"], key=ctx["key"], content_hash=ctx["content_hash"])
+        return ctx
+
+    def stage_parse(self, ctx):
+        url = ctx["url"]
+        soup = self.make_soup(ctx.pop("html"))
+        meta = self.extract_metadata(soup)
         # category = self.parse_category(soup)
         # print(category)
         content_div = self.extract_content_div(soup)
         if not content_div:
-            print(f"Failed to parse article: {url}")
-            return
-        short_id = self.generate_short_id(f"{title}-{date_string}")
+            raise ArticleParseError(f"Failed to parse article: {url}")
+        ctx.update(title=meta.title, date=meta.date, category=meta.albums, thumb_url=meta.thumbnail,
+                   author=meta.author, metadata=meta, content=content_div,
+                   short_id=self.generate_short_id(f"{meta.title}-{meta.date}"))
+        return ctx
+
+    def stage_assets(self, ctx):
+        short_id, thumb_url = ctx["short_id"], ctx["thumb_url"]
         article_img_dir = os.path.join(self.images_dir, short_id)
-        thumbnail_path = f"/images/{short_id}/thumbnail.png" if thumb_url else ""
-        if thumb_url and self.download_images:
+        ctx["thumbnail"] = f"/images/{short_id}/thumbnail.png" if thumb_url else ""
+        assets = ctx.setdefault("assets", [])
+        thumb_future = None
+        if thumb_url and self.offline:
+            # 优先用已生成的小缩略图
+            for stem in ("thumbnail-small", "thumbnail"):
+                name = self.existing_image(article_img_dir, stem)
+                if name:
+                    assets.append(os.path.join(article_img_dir, name))
+                    ctx["thumbnail"] = f"/images/{short_id}/{name}"
+                    break
+            else:
+                assets.append(os.path.join(article_img_dir, "thumbnail.png"))
+        elif thumb_url and self.asset_plan is not None:
+            thumb_name = f"thumbnail.{guess_image_extension(thumb_url)}"
+            thumb_path = os.path.join(article_img_dir, thumb_name)
+            self.asset_plan.add(thumb_url, thumb_path)
+            assets.append(thumb_path)
+            ctx["thumbnail"] = f"/images/{short_id}/{thumb_name}"
+        elif thumb_url and self.download_images:
             os.makedirs(article_img_dir, exist_ok=True)
-            self.download_file(thumb_url, os.path.join(article_img_dir, "thumbnail.png"))
-        self.download_images_and_replace(content_div, article_img_dir, short_id)
-        markdown_body = self.html_to_markdown(content_div)
-        markdown_content = self.generate_front_matter(title, date_string, url, thumbnail_path, category, author) + "\n" + markdown_body
-        self.save_markdown(short_id, markdown_content, date_string)
-
-    def crawl_batch(self, pid_list):
-        base_url = "https://mp.weixin.qq.com/s/{pid}"
-        for pid in pid_list:
+            thumb_path = os.path.join(article_img_dir, "thumbnail.png")
+            thumb_future = self.downloader.submit(thumb_url, thumb_path)
+        self.download_images_and_replace(ctx["content"], article_img_dir, short_id, outputs=assets)
+        if thumb_future is not None:
+            deadline = current_deadline()
             try:
-                url = base_url.format(pid=pid)
-                self.crawl_single(url)
-            except Exception:
-                print(f"Failed to crawl {url}: {traceback.format_exc()}")
+                ok = thumb_future.result(timeout=max(0, deadline.remaining()) if deadline else None)
+            except FutureTimeoutError:
+                # 和正文图片一样，到期时取消尚未开始的下载，算作暂时失败
+                thumb_future.cancel()
+                logger.warning(f"Cancelled download {thumb_url} (deadline exceeded)")
+                ok = False
+            except PermanentDownloadError:
+                # 封面已不存在，重新运行也下载不到，按没有封面处理，不记占位
+                ctx["thumbnail"] = ""
+                ok = None
+            if ok:
+                ctx["thumbnail"] = self.process_thumbnail(thumb_url, thumb_path, short_id, assets)
+            elif ok is not None:
+                # 封面暂时下载失败，记下占位路径，下次运行重新处理
+                assets.append(thumb_path)
+        return ctx
+
+    def process_thumbnail(self, thumb_url, thumb_path, short_id, assets):
+        """封面修正扩展名后再生成小缩略图，front matter 优先使用缩略图"""
+        processor = self.asset_processor
+        path = thumb_path
+        key = canonical_asset_url(thumb_url)
+        try:
+            path = processor.submit(thumb_path, self.content_types.pop(key, None), key).result()
+            small = processor.submit_thumbnail(path, key).result()
+        except Exception as e:
+            logger.warning(f"Failed to process thumbnail {path} ({e})")
+            small = None
+        assets.append(path)
+        if small:
+            assets.append(small)
+            path = small
+        return f"/images/{short_id}/{os.path.basename(path)}"
+
+    def stage_convert(self, ctx):
+        markdown_body = self.html_to_markdown(ctx.pop("content"))
+        front_matter = self.generate_front_matter(ctx["title"], ctx["date"], ctx["url"], ctx["thumbnail"],
+                                                  ctx["category"], ctx["author"])
+        ctx["markdown"] = front_matter + "\n" + markdown_body
+        return ctx
+
+    def crawl_single(self, url):
+        """抓取一篇文章；解析不到正文时打印提示并返回，抓取失败等其他错误照常抛出"""
+        try:
+            self.run_stages({"key": url, "url": url, "source_id": url})
+        except ArticleParseError as e:
+            print(e)
+
+    def article_item(self, pid):
+        url = self.ARTICLE_URL.format(pid=pid)
+        return {"key": pid, "url": url, "source_id": url}
+
+    def reprocess(self, processes=None):
+        """
+        从归档离线重新生成全部文章，不发任何网络请求，图片引用本地已下载的文件。
+        按页面分给 processes 个进程（None 为全部 CPU 核心，需要在 if __name__ == "__main__" 下调用）。
+        返回 {key: 错误信息}。需要以 archive=True 创建爬虫。
+        """
+        if self.archive is None:
+            raise ValueError("reprocess requires archive=True")
+        records = self.archive.records()
+        options = {"blog_root": self.blog_root, "parser": self.parser, "parse_only": self.parse_only}
+        errors = {}
+        self.begin_run(len(records))
+        try:
+            # 进度输出等线程已在运行，子进程用 spawn 创建，避免 fork 继承被持有的锁
+            with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_reprocess_worker,
+                                     initargs=(type(self), options, self.archive.data_path)) as pool:
+                for result in pool.map(_reprocess_record, records, chunksize=8):
+                    if "error" in result:
+                        errors[result["key"]] = result["error"]
+                        self.metrics.incr("articles_failed")
+                        continue
+                    self.metrics.incr("articles_written")
+                    if self.manifest is not None:
+                        self.manifest.record(result["source_id"], result["content_hash"], result["outputs"])
+        finally:
+            self.end_run()
+        self.print_batch_summary(len(records), errors)
+        return errors
+
+    def reprocess_page(self, url, html, key=None):
+        """用归档中的页面离线执行 parse→assets→convert→write，返回处理后的上下文"""
+        ctx = {"key": key or url, "url": url, "source_id": url, "html": html,
+               "content_hash": hashlib.md5(html.encode("utf-8")).hexdigest()}
+        return self.run_stages(ctx, self.REPROCESS_STAGES)
+
+    def crawl_batch(self, pid_list, max_workers=None, stage_workers=None, force=False):
+        """
+        批量抓取：文章按 fetch→parse→assets→convert→write 流水线处理。
+        max_workers 为网络阶段的默认并发数，stage_workers 可单独指定各阶段线程数。
+        公众号文章发布后不再变化，清单中已是最新的 pid 不再请求，force=True 时全部重新抓取。
+        设置了 shard 时只处理属于本分片的 pid。
+        失败不中断，结束后统一输出汇总，返回 {pid: 错误信息}。
+        """
+        max_workers = max_workers or self.max_workers
+        workers = {"fetch": max_workers, "assets": max_workers}
+        workers.update(stage_workers or {})
+        if self.shard is not None:
+            # 抓取前还不知道标题，按 pid 的短 ID 分片
+            total = len(pid_list)
+            pid_list = [pid for pid in pid_list if self.in_shard(self.generate_short_id(pid))]
+            print(f"Shard {self.shard[0]}/{self.shard[1]}: {len(pid_list)} of {total} articles")
+        items = (self.article_item(pid) for pid in pid_list)
+        skipped = []
+        if not force:
+            items = self.skip_unchanged(items, skipped)
+        self.begin_run(len(pid_list))
+        try:
+            errors = self.run_pipeline(items, workers)
+        finally:
+            self.end_run()
+        self.print_batch_summary(len(pid_list), errors, skipped)
+        return errors
+
+
+# 博客园后台分类接口返回的分类列表，get_category 默认使用，换成自己博客的分类即可
+CNBLOGS_CATEGORIES = [
+    {
+        "categoryId": 1273381,
+        "id": 1273381,
+        "key": "1273381",
+        "title": "Django",
+        "visible": True,
+        "order": None,
+        "itemCount": 4,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1396784,
+        "id": 1396784,
+        "key": "1396784",
+        "title": "docker",
+        "visible": True,
+        "order": None,
+        "itemCount": 11,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1402308,
+        "id": 1402308,
+        "key": "1402308",
+        "title": "java",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1392565,
+        "id": 1392565,
+        "key": "1392565",
+        "title": "js",
+        "visible": True,
+        "order": None,
+        "itemCount": 3,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 2064019,
+        "id": 2064019,
+        "key": "2064019",
+        "title": "Keycloak",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1322758,
+        "id": 1322758,
+        "key": "1322758",
+        "title": "linux",
+        "visible": True,
+        "order": None,
+        "itemCount": 10,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1466002,
+        "id": 1466002,
+        "key": "1466002",
+        "title": "mac-python3环境搭建",
+        "visible": True,
+        "order": None,
+        "itemCount": 4,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1304232,
+        "id": 1304232,
+        "key": "1304232",
+        "title": "Mongo",
+        "visible": True,
+        "order": None,
+        "itemCount": 5,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1780329,
+        "id": 1780329,
+        "key": "1780329",
+        "title": "PostgreSQL",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1504115,
+        "id": 1504115,
+        "key": "1504115",
+        "title": "pyqt5",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1245403,
+        "id": 1245403,
+        "key": "1245403",
+        "title": "python高级",
+        "visible": True,
+        "order": None,
+        "itemCount": 16,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1250376,
+        "id": 1250376,
+        "key": "1250376",
+        "title": "python基础",
+        "visible": True,
+        "order": None,
+        "itemCount": 13,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1259200,
+        "id": 1259200,
+        "key": "1259200",
+        "title": "python经典题",
+        "visible": True,
+        "order": None,
+        "itemCount": 3,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1250759,
+        "id": 1250759,
+        "key": "1250759",
+        "title": "python爬虫",
+        "visible": True,
+        "order": None,
+        "itemCount": 34,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1602829,
+        "id": 1602829,
+        "key": "1602829",
+        "title": "redis",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1342475,
+        "id": 1342475,
+        "key": "1342475",
+        "title": "shell",
+        "visible": True,
+        "order": None,
+        "itemCount": 2,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1423204,
+        "id": 1423204,
+        "key": "1423204",
+        "title": "sublime",
+        "visible": True,
+        "order": None,
+        "itemCount": 2,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1401056,
+        "id": 1401056,
+        "key": "1401056",
+        "title": "tomcat",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1348041,
+        "id": 1348041,
+        "key": "1348041",
+        "title": "tornado",
+        "visible": True,
+        "order": None,
+        "itemCount": 1,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1589641,
+        "id": 1589641,
+        "key": "1589641",
+        "title": "爆笑时刻",
+        "visible": True,
+        "order": None,
+        "itemCount": 2,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1621410,
+        "id": 1621410,
+        "key": "1621410",
+        "title": "搭建在线视频网站",
+        "visible": True,
+        "order": None,
+        "itemCount": 4,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    },
+    {
+        "categoryId": 1554329,
+        "id": 1554329,
+        "key": "1554329",
+        "title": "微信公众号",
+        "visible": True,
+        "order": None,
+        "itemCount": 4,
+        "selfItemCount": None,
+        "childCount": 0,
+        "descendantIds": [],
+        "parentId":  None,
+        "isLeaf": True,
+        "children": []
+    }
+]
+
+
+_reprocess_state = {}
+
+
+def _init_reprocess_worker(crawler_cls, options, data_path):
+    """reprocess 子进程初始化：离线爬虫，不写清单和搜索索引（由主进程处理）"""
+    crawler = crawler_cls(incremental=False, search_index=False, dedupe_assets=False, rate_limit=False,
+                          proxy=None, archive=False, **options)
+    crawler.offline = True
+    _reprocess_state["crawler"] = crawler
+    _reprocess_state["file"] = open(data_path, "rb")
+
+
+def _reprocess_record(record):
+    url, offset, length = record
+    crawler = _reprocess_state["crawler"]
+    try:
+        header, html = PageArchive.read_record(_reprocess_state["file"], offset, length)
+        ctx = crawler.reprocess_page(url, html, header.get("key"))
+        return {"key": ctx["key"], "source_id": ctx["source_id"], "content_hash": ctx["content_hash"],
+                "outputs": [ctx["filepath"]] + ctx.get("assets", [])}
+    except Exception:
+        return {"key": url, "error": traceback.format_exc()}
 
 
 class XmlArticleCrawler(BaseMarkdownCrawler):
     """将博客园 XML 文件中的文章转换为 Markdown，下载资源"""
-    def __init__(self, xml_files, **kwargs):
+    # extract 在读取线程内完成（流式模式下 entry 产出后即被清空），其余阶段走流水线
+    STAGES = ("assets", "convert", "write")
+
+    def __init__(self, xml_files, stream=False, chunk_size=1024 * 1024, convert_processes=0,
+                 category_file=None, **kwargs):
         super().__init__(**kwargs)
         self.xml_files = xml_files
-        self.CATEGORIES = {'https://www.cnblogs.com/mswei/p/9988197.html': ['Django'], 'https://www.cnblogs.com/mswei/p/9988084.html': ['Django'], 'https://www.cnblogs.com/mswei/p/9442097.html': ['Django'], 'https://www.cnblogs.com/mswei/p/9441593.html': ['Django'], 'https://www.cnblogs.com/mswei/p/15568561.html': ['docker', 'Keycloak'], 'https://www.cnblogs.com/mswei/p/11981368.html': ['docker'], 'https://www.cnblogs.com/mswei/p/12073942.html': ['docker', 'python高级'], 'https://www.cnblogs.com/mswei/p/11849418.html': ['docker', 'mac-python3环境搭建'], 'https://www.cnblogs.com/mswei/p/11691009.html': ['docker', 'linux'], 'https://www.cnblogs.com/mswei/p/10365613.html': ['docker'], 'https://www.cnblogs.com/mswei/p/10365407.html': ['docker'], 'https://www.cnblogs.com/mswei/p/10365226.html': ['docker'], 'https://www.cnblogs.com/mswei/p/10364635.html': ['docker'], 'https://www.cnblogs.com/mswei/p/10364468.html': ['docker'], 'https://www.cnblogs.com/mswei/p/10406335.html': ['java'], 'https://www.cnblogs.com/mswei/p/14213448.html': ['js'], 'https://www.cnblogs.com/mswei/p/10335394.html': ['js'], 'https://www.cnblogs.com/mswei/p/10009191.html': ['js'], 'https://www.cnblogs.com/mswei/p/15149018.html': ['linux'], 'https://www.cnblogs.com/mswei/p/12160845.html': ['linux', 'Mongo'], 'https://www.cnblogs.com/mswei/p/12132232.html': ['linux'], 'https://www.cnblogs.com/mswei/p/11918484.html': ['linux', 'mac-python3环境搭建'], 'https://www.cnblogs.com/mswei/p/11643586.html': ['linux'], 'https://www.cnblogs.com/mswei/p/10572473.html': ['linux'], 'https://www.cnblogs.com/mswei/p/10368547.html': ['linux'], 'https://www.cnblogs.com/mswei/p/10245992.html': ['linux'], 'https://www.cnblogs.com/mswei/p/11760448.html': ['mac-python3环境搭建', 'sublime'], 'https://www.cnblogs.com/mswei/p/10881542.html': ['mac-python3环境搭建'], 'https://www.cnblogs.com/mswei/p/12769441.html': ['Mongo', 'python高级'], 'https://www.cnblogs.com/mswei/p/11692177.html': ['Mongo'], 'https://www.cnblogs.com/mswei/p/11691292.html': ['Mongo'], 'https://www.cnblogs.com/mswei/p/9683367.html': ['Mongo', 'python高级'], 'https://www.cnblogs.com/mswei/p/13044162.html': ['PostgreSQL'], 'https://www.cnblogs.com/mswei/p/11189916.html': ['pyqt5'], 'https://www.cnblogs.com/mswei/p/14761053.html': ['python高级', 'python爬虫'], 'https://www.cnblogs.com/mswei/p/14668360.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/14103539.html': ['python高级', 'python爬虫'], 'https://www.cnblogs.com/mswei/p/13970404.html': ['python高级', 'python基础'], 'https://www.cnblogs.com/mswei/p/11951609.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/11951181.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/11926290.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/11856258.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/11653471.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/10006076.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/9370238.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/9261859.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/9250690.html': ['python高级'], 'https://www.cnblogs.com/mswei/p/11598340.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9393957.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9296875.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9296379.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9292134.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9290363.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9286833.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9286151.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9283546.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9283417.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9283386.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9283297.html': ['python基础'], 'https://www.cnblogs.com/mswei/p/9356265.html': ['python经典题'], 'https://www.cnblogs.com/mswei/p/9346802.html': ['python经典题'], 'https://www.cnblogs.com/mswei/p/9346653.html': ['python经典题'], 'https://www.cnblogs.com/mswei/p/15568488.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/15568461.html': ['python爬虫', '微信公众号'], 'https://www.cnblogs.com/mswei/p/14168553.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/12175505.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/12174839.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/11653504.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/11602838.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/11232393.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9835370.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9405260.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9404846.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9392530.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9361917.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9344685.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9339649.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9337987.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9337936.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/9337845.html': ['python爬虫'], 'https://www.cnblogs.com/mswei/p/11956452.html': ['redis'], 'https://www.cnblogs.com/mswei/p/12767754.html': ['shell'], 'https://www.cnblogs.com/mswei/p/9965456.html': ['shell'], 'https://www.cnblogs.com/mswei/p/10558708.html': ['sublime'], 'https://www.cnblogs.com/mswei/p/10396812.html': ['tomcat'], 'https://www.cnblogs.com/mswei/p/10008504.html': ['tornado'], 'https://www.cnblogs.com/mswei/p/12145659.html': ['爆笑时刻'], 'https://www.cnblogs.com/mswei/p/11851000.html': ['爆笑时刻'], 'https://www.cnblogs.com/mswei/p/12103753.html': ['搭建在线视频网站'], 'https://www.cnblogs.com/mswei/p/12103700.html': ['搭建在线视频网站'], 'https://www.cnblogs.com/mswei/p/12103650.html': ['搭建在线视频网站'], 'https://www.cnblogs.com/mswei/p/12103518.html': ['搭建在线视频网站'], 'https://www.cnblogs.com/mswei/p/14180404.html': ['微信公众号'], 'https://www.cnblogs.com/mswei/p/12195576.html': ['微信公众号']}
+        # stream=True 时增量解析，内存占用与导出文件大小无关
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # HTML→Markdown 的进程数，0 为在当前进程转换，None 为使用全部 CPU
+        self.convert_processes = convert_processes
+        self.convert_pool = None
+        # 文章地址→分类索引，由 get_category 生成，转换时按需加载
+        self.category_file = category_file or os.path.join(self.blog_root, ".categories.json")
+        self._category_index = None
 
     def sanitize_xml(self, xml_content):
         # 删除非法 XML 控制字符
-        return re.sub(r"[\x00-\x08\x0B-\x0C\x0E-\x1F]", "", xml_content)
+        if isinstance(xml_content, bytes):
+            return XML_CONTROL_CHARS_BYTES.sub(b"", xml_content)
+        return XML_CONTROL_CHARS.sub("", xml_content)
 
     def parse_items(self, xml_content):
         xml_content = self.sanitize_xml(xml_content)
@@ -279,12 +3060,43 @@ class XmlArticleCrawler(BaseMarkdownCrawler):
         # Atom: 每篇文章是 <entry>
         return root.findall(".//{http://www.w3.org/2005/Atom}entry")
 
+    def iter_items(self, xml_file):
+        """
+        流式解析：分块读取并清理控制字符，每个 <entry> 闭合后立即产出，
+        调用方处理完后清空并从父节点摘除，保证内存不随文件增长。
+        """
+        parser = ET.XMLPullParser(events=("start", "end"))
+        stack = []
+
+        def drain():
+            for event, elem in parser.read_events():
+                if event == "start":
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if elem.tag == ATOM_NS + "entry":
+                    yield elem
+                    elem.clear()
+                    if stack:
+                        stack[-1].remove(elem)
+
+        with open(xml_file, "rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                parser.feed(self.sanitize_xml(chunk))
+                yield from drain()
+        parser.close()
+        yield from drain()
+
     def extract_text(self, elem, tag, ns="{http://www.w3.org/2005/Atom}"):
         found = elem.find(ns + tag)
         return found.text.strip() if found is not None and found.text else ""
 
-    def convert_item_to_markdown(self, item):
-        ns = "{http://www.w3.org/2005/Atom}"
+    def extract_item(self, item):
+        """从 <entry> 中取出转换所需字段，之后不再引用 XML 节点"""
+        ns = ATOM_NS
         title = self.extract_text(item, "title", ns)
         link_elem = item.find(f"{ns}link[@rel='alternate']")
         url = link_elem.get("href") if link_elem is not None else ""
@@ -298,390 +3110,259 @@ class XmlArticleCrawler(BaseMarkdownCrawler):
         author = author_elem.text.strip() if author_elem is not None else "胖胖不胖"
         content_elem = item.find(f"{ns}content")
         description_html = content_elem.text if content_elem is not None else ""
+        # 分类写在 front matter 里，get_category 更新分类后文章要重新生成
+        categories = self.category_index.get(url, [])
+        source = "\n".join([title, url, date, author, description_html or "",
+                            json.dumps(categories, ensure_ascii=False)])
+        return {"key": url or title, "source_id": url or f"{title}-{date}",
+                "content_hash": hashlib.md5(source.encode("utf-8")).hexdigest(),
+                "title": title, "url": url, "date": date, "author": author,
+                "html": description_html, "short_id": self.generate_short_id(f"{title}-{date}")}
 
-        short_id = self.generate_short_id(f"{title}-{date}")
+    def stage_assets(self, ctx):
+        short_id = ctx["short_id"]
         article_img_dir = os.path.join(self.images_dir, short_id)
         # 下载并替换图片路径
-        description_html = self.download_images_and_replace(description_html, article_img_dir, short_id)
-        # 转 Markdown
-        markdown_body = md(description_html, heading_style="ATX", code_language_detection=True)
+        ctx["html"] = self.download_images_and_replace(ctx["html"], article_img_dir, short_id,
+                                                       outputs=ctx.setdefault("assets", []))
+        return ctx
+
+    def stage_convert(self, ctx):
+        # 转 Markdown：开启进程池时只提交 HTML 字符串，结果在 write 阶段按顺序取回
+        if self.convert_pool is not None:
+            ctx["markdown_body"] = self.convert_pool.submit(html_to_markdown, ctx.pop("html"))
+        else:
+            ctx["markdown_body"] = html_to_markdown(ctx.pop("html"))
         # YAML 头信息
         thumbnail_path = "/images/default-post-thumbnail.png"  # XML 没封面，使用默认
-        categories = self.CATEGORIES.get(url, ["Cnblogs"])
+        categories = self.category_index.get(ctx["url"], ["Cnblogs"])
         tags_yaml = "\n".join(f"    - {tag}" for tag in (categories or ["Python"]))
 
         front_matter = HEADER.format(
-            title=title, date=date, url=url, thumbnail=thumbnail_path,
-            tags_yaml=tags_yaml, author=author, categories=(categories[0:] if categories else ["Cnblogs"])[0]
+            title=ctx["title"], date=ctx["date"], url=ctx["url"], thumbnail=thumbnail_path,
+            tags_yaml=tags_yaml, author=ctx["author"], categories=(categories[0:] if categories else ["Cnblogs"])[0]
         )
-        markdown_content = front_matter + "\n" + markdown_body
-        self.save_markdown(short_id, markdown_content, date)
-
-    def get_category(self):
-        categories = [
-            {
-                "categoryId": 1273381,
-                "id": 1273381,
-                "key": "1273381",
-                "title": "Django",
-                "visible": True,
-                "order": None,
-                "itemCount": 4,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1396784,
-                "id": 1396784,
-                "key": "1396784",
-                "title": "docker",
-                "visible": True,
-                "order": None,
-                "itemCount": 11,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1402308,
-                "id": 1402308,
-                "key": "1402308",
-                "title": "java",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1392565,
-                "id": 1392565,
-                "key": "1392565",
-                "title": "js",
-                "visible": True,
-                "order": None,
-                "itemCount": 3,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 2064019,
-                "id": 2064019,
-                "key": "2064019",
-                "title": "Keycloak",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1322758,
-                "id": 1322758,
-                "key": "1322758",
-                "title": "linux",
-                "visible": True,
-                "order": None,
-                "itemCount": 10,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1466002,
-                "id": 1466002,
-                "key": "1466002",
-                "title": "mac-python3环境搭建",
-                "visible": True,
-                "order": None,
-                "itemCount": 4,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1304232,
-                "id": 1304232,
-                "key": "1304232",
-                "title": "Mongo",
-                "visible": True,
-                "order": None,
-                "itemCount": 5,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1780329,
-                "id": 1780329,
-                "key": "1780329",
-                "title": "PostgreSQL",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1504115,
-                "id": 1504115,
-                "key": "1504115",
-                "title": "pyqt5",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1245403,
-                "id": 1245403,
-                "key": "1245403",
-                "title": "python高级",
-                "visible": True,
-                "order": None,
-                "itemCount": 16,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1250376,
-                "id": 1250376,
-                "key": "1250376",
-                "title": "python基础",
-                "visible": True,
-                "order": None,
-                "itemCount": 13,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1259200,
-                "id": 1259200,
-                "key": "1259200",
-                "title": "python经典题",
-                "visible": True,
-                "order": None,
-                "itemCount": 3,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1250759,
-                "id": 1250759,
-                "key": "1250759",
-                "title": "python爬虫",
-                "visible": True,
-                "order": None,
-                "itemCount": 34,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1602829,
-                "id": 1602829,
-                "key": "1602829",
-                "title": "redis",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1342475,
-                "id": 1342475,
-                "key": "1342475",
-                "title": "shell",
-                "visible": True,
-                "order": None,
-                "itemCount": 2,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1423204,
-                "id": 1423204,
-                "key": "1423204",
-                "title": "sublime",
-                "visible": True,
-                "order": None,
-                "itemCount": 2,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1401056,
-                "id": 1401056,
-                "key": "1401056",
-                "title": "tomcat",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1348041,
-                "id": 1348041,
-                "key": "1348041",
-                "title": "tornado",
-                "visible": True,
-                "order": None,
-                "itemCount": 1,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1589641,
-                "id": 1589641,
-                "key": "1589641",
-                "title": "爆笑时刻",
-                "visible": True,
-                "order": None,
-                "itemCount": 2,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1621410,
-                "id": 1621410,
-                "key": "1621410",
-                "title": "搭建在线视频网站",
-                "visible": True,
-                "order": None,
-                "itemCount": 4,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            },
-            {
-                "categoryId": 1554329,
-                "id": 1554329,
-                "key": "1554329",
-                "title": "微信公众号",
-                "visible": True,
-                "order": None,
-                "itemCount": 4,
-                "selfItemCount": None,
-                "childCount": 0,
-                "descendantIds": [],
-                "parentId":  None,
-                "isLeaf": True,
-                "children": []
-            }
-        ]
-        result = {}
-        base_url = "https://www.cnblogs.com/mswei/category/{category_id}.html"
-        for cat in categories:
-            category_id = cat["categoryId"]
-            category_name = cat["title"]
-            url = base_url.format(category_id=category_id)
+        ctx["front_matter"] = front_matter
+        return ctx
+
+    def stage_write(self, ctx):
+        markdown_body = ctx.pop("markdown_body")
+        if isinstance(markdown_body, Future):
+            markdown_body = markdown_body.result()
+        ctx["markdown"] = ctx.pop("front_matter") + "\n" + markdown_body
+        return super().stage_write(ctx)
+
+    def convert_item_to_markdown(self, item):
+        self.run_stages(self.extract_item(item))
 
-            print(f"Fetching category: {category_name} ({url})")
-            html = self.fetch_article(url)
+    def load_category_file(self, warn=False):
+        if os.path.exists(self.category_file):
+            with open(self.category_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        if warn:
+            logger.warning(f"No category index at {self.category_file}, all posts will use the default category; "
+                           f"run get_category() first")
+        return {"categories": {}}
 
-            soup = BeautifulSoup(html, "html.parser")
-            links = soup.select("a.entrylistItemTitle")
+    def save_category_file(self, data):
+        tmp_path = f"{self.category_file}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.category_file)
 
-            for a in links:
-                href = a.get("href")
-                if href not in result:
-                    result[href] = []
-                result[href].append(category_name)
+    @staticmethod
+    def build_category_index(data):
+        """{分类id: {title, urls}} → {文章地址: [分类名]}，分类顺序与保存时一致"""
+        index = {}
+        for cat in data["categories"].values():
+            for href in cat["urls"]:
+                index.setdefault(href, []).append(cat["title"])
+        return index
 
-        print(result)
+    @property
+    def category_index(self):
+        """文章地址→分类，第一次用到时才从 category_file 加载"""
+        if self._category_index is None:
+            self._category_index = self.build_category_index(self.load_category_file(warn=True))
+        return self._category_index
+
+    def fetch_category_page(self, url):
+        """返回 (本页文章地址列表, 最大页码)"""
+        html = self.fetch_article(url)
+        soup = BeautifulSoup(html, "html.parser", parse_only=SoupStrainer("a"))
+        links = [a.get("href") for a in soup.select("a.entrylistItemTitle") if a.get("href")]
+        path = re.escape(urlparse(url).path)
+        pages = [int(n) for n in re.findall(path + r"\?page=(\d+)", html)]
+        return links, max(pages, default=1)
+
+    def get_category(self, categories=None, blog="mswei", max_workers=8, force=False):
+        """
+        抓取博客园分类页（含分页）生成 文章地址→分类 索引，保存到 category_file（默认 blog_root/.categories.json）。
+        categories 为博客后台分类接口返回的列表，默认 CNBLOGS_CATEGORIES，不在列表中的分类会从索引移除。
+        每次都重新请求各分类的第一页，第一页的文章和页数与上次相同时沿用上次的结果，否则再抓取其余分页；
+        force=True 时全部重新抓取。各分类和分页并发请求，单个分类失败时保留上次的结果。返回 {文章地址: [分类名]}。
+        """
+        categories = CNBLOGS_CATEGORIES if categories is None else categories
+        saved = self.load_category_file()["categories"]
+        cats = {str(cat["categoryId"]): cat for cat in categories}
+        result = {key: saved.get(key) for key in cats}
+
+        base_url = f"https://www.cnblogs.com/{blog}/category/{{category_id}}.html"
+        failed = []
+        refreshed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            first = {pool.submit(self.fetch_category_page, base_url.format(category_id=key)): key for key in cats}
+            pages = {}
+            for future in as_completed(first):
+                key = first[future]
+                url = base_url.format(category_id=key)
+                try:
+                    links, last_page = future.result()
+                except Exception as e:
+                    logger.warning(f"Failed to fetch category {cats[key]['title']} ({e})")
+                    failed.append(key)
+                    continue
+                old = saved.get(key)
+                if (not force and old and old.get("first_page") == links and old.get("pages") == last_page
+                        and old["title"] == cats[key]["title"]):
+                    continue
+                logger.info(f"Fetched category: {cats[key]['title']} ({url}), {last_page} page(s)")
+                pages[key] = (links, last_page, [pool.submit(self.fetch_category_page, f"{url}?page={n}")
+                                                 for n in range(2, last_page + 1)])
+            for key, (links, last_page, rest) in pages.items():
+                urls = list(links)
+                try:
+                    for future in rest:
+                        urls.extend(future.result()[0])
+                except Exception as e:
+                    logger.warning(f"Failed to fetch category {cats[key]['title']} ({e})")
+                    failed.append(key)
+                    continue
+                refreshed += 1
+                result[key] = {"title": cats[key]["title"], "first_page": links, "pages": last_page,
+                               "urls": list(dict.fromkeys(urls))}
+
+        data = {"updated_at": datetime.now().isoformat(timespec="seconds"),
+                "categories": {key: cat for key, cat in result.items() if cat is not None}}
+        self.save_category_file(data)
+        self._category_index = self.build_category_index(data)
+        print(f"Indexed {len(self._category_index)} articles in {len(data['categories'])} categories, "
+              f"{refreshed} refreshed, {len(failed)} failed")
+        return self._category_index
 
     def crawl(self):
+        if self.convert_processes != 0:
+            # 所有 xml 文件共用一个进程池；write 阶段单线程按提交顺序取结果，输出顺序与串行一致。
+            # 子进程在流水线线程已运行时才创建，fork 可能继承被其它线程持有的锁，因此用 spawn
+            self.convert_pool = ProcessPoolExecutor(max_workers=self.convert_processes,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        self.begin_run()
+        try:
+            self._crawl_files()
+        finally:
+            self.end_run()
+            if self.convert_pool is not None:
+                self.convert_pool.shutdown()
+                self.convert_pool = None
+
+    def _crawl_files(self):
         for xml_file in self.xml_files:
             try:
-                with open(xml_file, "r", encoding="utf-8") as f:
-                    content = f.read()
-                items = self.parse_items(content)
-                print("post items lenth: ", len(items))
-                for item in items:
-                    self.convert_item_to_markdown(item)
+                total, errors, skipped = self.crawl_file(xml_file)
+                self.print_batch_summary(total, errors, skipped)
             except Exception:
-                print(f"Failed to process {xml_file}: {traceback.format_exc()}")
+                logger.error(f"Failed to process {xml_file}: {traceback.format_exc()}")
+
+    def crawl_file(self, xml_file):
+        """
+        处理单个导出文件，返回 (文章数, {key: 错误信息}, 跳过的 key)；文件无法解析时抛出异常。
+        设置了 shard 时只处理标题-日期的短 ID 属于本分片的文章，文章数也只算这些。
+        """
+        counter = {"count": 0}
+
+        def entries(items):
+            for item in items:
+                ctx = self.extract_item(item)
+                if not self.in_shard(ctx["short_id"]):
+                    continue
+                counter["count"] += 1
+                yield ctx
+
+        if self.stream:
+            items = self.iter_items(xml_file)
+        else:
+            with open(xml_file, "r", encoding="utf-8") as f:
+                content = f.read()
+            items = self.parse_items(content)
+            logger.info(f"post items lenth: {len(items)}")
+        skipped = []
+        errors = self.run_pipeline(self.skip_unchanged(entries(items), skipped))
+        return counter["count"], errors, skipped
+
+
+POST_NAME_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}-(\w+)\.md$")
+
+
+def merge_shards(sources, blog_root, search_index=True):
+    """
+    把各分片节点的输出（sources 为各自的 blog_root）合并到 blog_root 的 _posts 和 images。
+    同一路径内容相同的只保留一份；本次合并中两个分片的同一路径内容不同时记为冲突，保留先合并的那份；
+    目标中已有的旧文件被分片的新结果覆盖。一个短 ID 对应多篇文章（文件名不同，共用 images/<短 ID>）记为 ID 冲突。
+    文章复制，图片尽量硬链接。search_index=True 时合并后重建目标的搜索索引。
+    返回 {"posts": 写入的文章数, "images": 写入的图片数, "conflicts": [(路径, 已保留的来源, 被跳过的来源)],
+    "collisions": {短 ID: [文章文件名]}}。
+    """
+    posts_dir = os.path.join(blog_root, "_posts")
+    images_dir = os.path.join(blog_root, "images")
+    report = {"posts": 0, "images": 0, "conflicts": [], "collisions": {}}
+    claimed = {}  # 目标路径 -> 本次写入它的分片文件
+
+    def merge_file(src, dest, kind):
+        owner = claimed.get(dest)
+        if os.path.exists(dest) and filecmp.cmp(src, dest, shallow=False):
+            claimed.setdefault(dest, src)
+            return
+        if owner is not None:
+            report["conflicts"].append((os.path.relpath(dest, blog_root), owner, src))
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if kind == "posts":
+            # 文章会被原地改写，不能和分片共用 inode
+            tmp_path = f"{dest}.{uuid.uuid4().hex[:8]}.tmp"
+            shutil.copy2(src, tmp_path)
+            os.replace(tmp_path, dest)
+        else:
+            AssetStore.link_file(src, dest)
+        claimed[dest] = src
+        report[kind] += 1
+
+    for source in sources:
+        src_posts = os.path.join(source, "_posts")
+        if os.path.isdir(src_posts):
+            for entry in os.scandir(src_posts):
+                if entry.name.endswith(".md"):
+                    merge_file(entry.path, os.path.join(posts_dir, entry.name), "posts")
+        src_images = os.path.join(source, "images")
+        for root, _, files in os.walk(src_images):
+            for name in files:
+                if name.endswith((".part", ".tmp")):
+                    continue
+                src = os.path.join(root, name)
+                merge_file(src, os.path.join(images_dir, os.path.relpath(src, src_images)), "images")
+
+    os.makedirs(posts_dir, exist_ok=True)
+    by_id = {}
+    for name in sorted(os.listdir(posts_dir)):
+        m = POST_NAME_PATTERN.match(name)
+        if m:
+            by_id.setdefault(m.group(1), []).append(name)
+    report["collisions"] = {short_id: names for short_id, names in by_id.items() if len(names) > 1}
+
+    if search_index:
+        index = SearchIndex(os.path.join(blog_root, "search"), os.path.join(blog_root, ".search.sqlite"))
+        index.sync_posts(posts_dir)
+        index.flush()
+    return report
 
 
 if __name__ == "__main__":
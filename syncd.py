@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""
+后台同步服务：微信文章 pid 和博客园导出文件放进持久化任务队列（SQLite），由工作线程池持续处理。
+
+    python syncd.py serve --blog-root ../source --workers 4 --http 127.0.0.1:8765
+    python syncd.py add C75Haa47Oeq5DsPwA0BMSw t27RQEsrYJzjxEJr4PWgMA
+    python syncd.py add-xml cnblogs_blog_mswei.20250728163812.xml
+    python syncd.py status
+    python syncd.py --blog-root node0 serve --shard 0/2        # 多台机器各跑一个分片
+    python syncd.py --blog-root ../source merge node0 node1    # 合并各分片的输出
+
+add / add-xml / status 直接读写队列文件，服务没启动时也能用，服务每秒检查一次新任务；
+通过 HTTP 提交的任务会立即开始。重启后，上次中断在运行中的任务重新排队，
+已经写完的文章由增量清单跳过，不会重复下载和转换。
+分片运行时每个节点添加全部任务即可，不属于本分片的文章直接跳过。
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import postHelper
+
+logger = logging.getLogger("xmlTomd.syncd")
+
+STATUSES = ("queued", "running", "done", "failed")
+
+
+class JobQueue:
+    """
+    持久化任务队列。任务有 queued → running → done / failed 四种状态；
+    失败后按 retry_delay * 2^n 延迟重新排队，超过 max_attempts 次记为 failed。
+    同一目标已在排队或运行中时重复提交返回原任务。
+    """
+    def __init__(self, path, max_attempts=3, retry_delay=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        # 命令行和服务可能同时访问，WAL 模式下读写互不阻塞
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, target TEXT, status TEXT, "
+                "attempts INTEGER DEFAULT 0, run_after REAL DEFAULT 0, claim TEXT, "
+                "error TEXT, result TEXT, created_at TEXT, updated_at TEXT)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after)")
+
+    @staticmethod
+    def now():
+        return datetime.now().isoformat(timespec="seconds")
+
+    def enqueue(self, kind, target):
+        """返回任务 id"""
+        with self._lock, self.conn:
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND target = ? AND status IN ('queued', 'running')",
+                (kind, target)
+            ).fetchone()
+            if row:
+                return row[0]
+            return self.conn.execute(
+                "INSERT INTO jobs (kind, target, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                (kind, target, self.now(), self.now())
+            ).lastrowid
+
+    def claim(self):
+        """取出一个到期的排队任务并标记为运行中，没有时返回 None"""
+        token = uuid.uuid4().hex
+        with self._lock, self.conn:
+            # 单条 UPDATE 是原子的，多个进程同时取任务也不会取到同一个
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', claim = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ? ORDER BY id LIMIT 1)",
+                (token, self.now(), time.time())
+            )
+            row = self.conn.execute("SELECT id, kind, target, attempts FROM jobs WHERE claim = ?",
+                                    (token,)).fetchone()
+        return dict(zip(("id", "kind", "target", "attempts"), row)) if row else None
+
+    def complete(self, job_id, result):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'done', error = NULL, result = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(result, ensure_ascii=False), self.now(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        with self._lock, self.conn:
+            attempts = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            if attempts < self.max_attempts:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, run_after = ?, updated_at = ? WHERE id = ?",
+                    (error, time.time() + self.retry_delay * 2 ** (attempts - 1), self.now(), job_id)
+                )
+            else:
+                self.conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                                  (error, self.now(), job_id))
+
+    def recover(self):
+        """服务启动时调用：上次中断时仍在运行的任务重新排队，返回数量"""
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "UPDATE jobs SET status = 'queued', run_after = 0, updated_at = ? WHERE status = 'running'",
+                (self.now(),)
+            ).rowcount
+
+    def retry_failed(self):
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, run_after = 0, updated_at = ? "
+                "WHERE status = 'failed'", (self.now(),)
+            ).rowcount
+
+    def counts(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict({s: 0 for s in STATUSES}, **dict(rows))
+
+    def jobs(self, status=None, limit=20):
+        query = "SELECT id, kind, target, status, attempts, error, result, updated_at FROM jobs"
+        args = ()
+        if status:
+            query += " WHERE status = ?"
+            args = (status,)
+        with self._lock:
+            rows = self.conn.execute(query + " ORDER BY id DESC LIMIT ?", args + (limit,)).fetchall()
+        keys = ("id", "kind", "target", "status", "attempts", "error", "result", "updated_at")
+        jobs = [dict(zip(keys, row)) for row in rows]
+        for job in jobs:
+            job["result"] = json.loads(job["result"]) if job["result"] else None
+        return jobs
+
+
+class SyncDaemon:
+    """
+    工作线程从队列取任务：wechat 任务抓取一篇文章，xml 任务处理一个导出文件。
+    两种爬虫共用增量清单、图片仓库、搜索索引、代理池和限速器；
+    有任务完成后每 flush_interval 秒写出一次搜索索引和运行指标。
+    """
+    def __init__(self, queue, workers=2, poll_interval=1.0, flush_interval=10.0, **crawler_options):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.wechat = postHelper.WeChatArticleCrawler(**crawler_options)
+        self.xml = postHelper.XmlArticleCrawler([], stream=True, shared=self.wechat, **crawler_options)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._dirty = threading.Event()
+        self._threads = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    def run_job(self, job):
+        """返回写入任务结果的摘要；失败时抛出异常"""
+        if job["kind"] == "wechat":
+            if not self.wechat.in_shard(self.wechat.generate_short_id(job["target"])):
+                return {"other_shard": 1}
+            ctx = self.wechat.article_item(job["target"])
+            manifest = self.wechat.manifest
+            if manifest is not None and manifest.is_current(ctx["source_id"]):
+                self.wechat.metrics.incr("articles_skipped")
+                return {"unchanged": 1}
+            self.wechat.run_stages(ctx)
+            return {"written": 1}
+        total, errors, skipped = self.xml.crawl_file(job["target"])
+        if errors and len(errors) + len(skipped) == total:
+            raise RuntimeError(f"All {len(errors)} articles failed")
+        return {"total": total, "unchanged": len(skipped), "failed": errors}
+
+    def _work(self):
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            logger.info(f"Job {job['id']}: {job['kind']} {job['target']} (attempt {job['attempts']})")
+            try:
+                self.queue.complete(job["id"], self.run_job(job))
+            except Exception as e:
+                logger.warning(f"Job {job['id']} failed: {e}")
+                logger.debug(traceback.format_exc())
+                self.queue.fail(job["id"], f"{type(e).__name__}: {e}")
+            self._dirty.set()
+
+    def start(self):
+        recovered = self.queue.recover()
+        if recovered:
+            logger.warning(f"Requeued {recovered} interrupted job(s)")
+        self._threads = [threading.Thread(target=self._work, name=f"syncd-{n}", daemon=True)
+                         for n in range(self.workers)]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def serve_forever(self):
+        try:
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+        finally:
+            for t in self._threads:
+                t.join()
+            self.flush()
+
+    def flush(self):
+        if self._dirty.is_set():
+            self._dirty.clear()
+            self.wechat.flush_outputs()
+
+    def stop(self):
+        """不再取新任务，正在运行的任务完成后退出"""
+        self._stop.set()
+        self._wakeup.set()
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    GET  /status            各状态任务数和最近的任务，可加 ?status=failed
+    POST /jobs              {"wechat": [pid, ...], "xml": [path, ...]}，返回任务 id
+    """
+    daemon = None
+
+    def log_message(self, fmt, *args):
+        logger.info("%s %s" % (self.address_string(), fmt % args))
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path != "/status":
+            return self.send_json({"error": "not found"}, 404)
+        params = dict(p.split("=", 1) for p in query.split("&") if "=" in p)
+        queue = self.daemon.queue
+        self.send_json({"counts": queue.counts(), "jobs": queue.jobs(params.get("status"))})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            return self.send_json({"error": "not found"}, 404)
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if not isinstance(data, dict):
+                raise ValueError("Expected a JSON object")
+            for key in ("wechat", "xml"):
+                value = data.get(key, [])
+                if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                    raise ValueError(f"{key} must be a list of strings")
+            ids = enqueue(self.daemon.queue, data.get("wechat", []), data.get("xml", []))
+        except (ValueError, AttributeError, TypeError) as e:
+            return self.send_json({"error": str(e)}, 400)
+        self.daemon.notify()
+        self.send_json({"jobs": ids}, 201)
+
+
+def enqueue(queue, pids=(), xml_files=()):
+    ids = [queue.enqueue("wechat", pid.strip()) for pid in pids if pid.strip()]
+    for path in xml_files:
+        if not os.path.exists(path):
+            raise ValueError(f"No such file: {path}")
+        ids.append(queue.enqueue("xml", os.path.abspath(path)))
+    return ids
+
+
+def start_api(daemon, address):
+    host, _, port = address.rpartition(":")
+    handler = type("Handler", (ApiHandler,), {"daemon": daemon})
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+    threading.Thread(target=server.serve_forever, name="syncd-http", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="xmlTomd 后台同步服务")
+    parser.add_argument("--blog-root", default=".", help="Jekyll 站点目录")
+    parser.add_argument("--queue", help="任务队列文件，默认 blog_root/.jobs.sqlite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="启动服务")
+    serve.add_argument("--workers", type=int, default=2, help="同时处理的任务数")
+    serve.add_argument("--http", help="开启 HTTP 接口，如 127.0.0.1:8765")
+    serve.add_argument("--proxy", default=postHelper.DEFAULT_PROXY, help="代理地址，direct 为直连")
+    serve.add_argument("--proxy-file", help="代理列表文件")
+    serve.add_argument("--http-cache", action="store_true", help="开启 HTTP 缓存")
+    serve.add_argument("--max-attempts", type=int, default=3)
+    serve.add_argument("--shard", type=postHelper.parse_shard, help="只处理第 i 片（i/n，从 0 开始）")
+    serve.add_argument("--verbose", action="store_true")
+    add = sub.add_parser("add", help="添加微信文章 pid")
+    add.add_argument("pids", nargs="+")
+    add_xml = sub.add_parser("add-xml", help="添加博客园导出文件")
+    add_xml.add_argument("files", nargs="+")
+    status = sub.add_parser("status", help="查看任务状态")
+    status.add_argument("--status", choices=STATUSES)
+    status.add_argument("--limit", type=int, default=20)
+    sub.add_parser("retry", help="失败的任务重新排队")
+    merge = sub.add_parser("merge", help="把各分片的 _posts 和 images 合并到 blog_root")
+    merge.add_argument("sources", nargs="+", help="各分片节点的 blog_root")
+    args = parser.parse_args(argv)
+
+    if args.command == "merge":
+        report = postHelper.merge_shards(args.sources, args.blog_root)
+        print(f"Merged {report['posts']} posts and {report['images']} images from {len(args.sources)} shard(s), "
+              f"{len(report['conflicts'])} conflicts, {len(report['collisions'])} id collisions")
+        for path, kept, skipped in report["conflicts"]:
+            print(f"Conflict: {path} differs in {skipped}, kept {kept}")
+        for short_id, names in report["collisions"].items():
+            print(f"Id collision: {short_id} used by {', '.join(names)}")
+        return 1 if report["conflicts"] or report["collisions"] else 0
+
+    queue_path = args.queue or os.path.join(args.blog_root, ".jobs.sqlite")
+    os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+    queue = JobQueue(queue_path, max_attempts=getattr(args, "max_attempts", 3))
+
+    if args.command == "add":
+        print(" ".join(map(str, enqueue(queue, args.pids))))
+    elif args.command == "add-xml":
+        print(" ".join(map(str, enqueue(queue, xml_files=args.files))))
+    elif args.command == "retry":
+        print(f"Requeued {queue.retry_failed()} job(s)")
+    elif args.command == "status":
+        print(" ".join(f"{k}={v}" for k, v in queue.counts().items()))
+        for job in queue.jobs(args.status, args.limit):
+            line = f"{job['id']:>6} {job['status']:<8} {job['kind']:<6} {job['target']}"
+            if job["error"]:
+                line += f"  ({job['error']})"
+            print(line)
+    else:
+        if args.verbose:
+            postHelper.enable_verbose_logging()
+        daemon = SyncDaemon(queue, workers=args.workers, blog_root=args.blog_root,
+                            proxy=None if args.proxy == "direct" else args.proxy, proxy_file=args.proxy_file,
+                            http_cache=args.http_cache or None, shard=args.shard).start()
+        if args.http:
+            start_api(daemon, args.http)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: daemon.stop())
+        print(f"Serving {queue_path} with {args.workers} worker(s)" + (f", http://{args.http}" if args.http else ""))
+        daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
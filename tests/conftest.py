@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+import postHelper  # noqa: E402
+
+
+class ScriptedHandler(benchmark.StandInHandler):
+    """在 benchmark 的模拟服务上按 server.config["respond"](path) 返回指定状态码，返回 None 时正常响应"""
+
+    def do_GET(self):
+        respond = self.server.config.get("respond")
+        status = respond(self.path) if respond else None
+        if status is None:
+            return super().do_GET()
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+        self.send_response(status)
+        if status in (429, 503):
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def stand_in():
+    server = benchmark.start_stand_in(latency=0, image_bytes=200, images=2, paragraphs=3, shared_images=0)
+    server.RequestHandlerClass = ScriptedHandler
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def wechat_crawler(tmp_path, stand_in):
+    def make(**kwargs):
+        kwargs.setdefault("blog_root", str(tmp_path / "blog"))
+        kwargs.setdefault("proxy", None)
+        crawler = postHelper.WeChatArticleCrawler(**kwargs)
+        crawler.ARTICLE_URL = stand_in.base_url + "/s/{pid}"
+        return crawler
+    return make
+
+
+def throttle_for(seconds):
+    """前 seconds 秒内所有请求返回 429"""
+    until = time.monotonic() + seconds
+    return lambda path: 429 if time.monotonic() < until else None
@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+
+def test_reprocess_rebuilds_posts_from_archive(stand_in, wechat_crawler):
+    assert wechat_crawler().crawl_batch(["p1", "p2"]) == {}
+    crawler = wechat_crawler()
+    for name in os.listdir(crawler.posts_dir):
+        os.remove(os.path.join(crawler.posts_dir, name))
+    requests_before = stand_in.stats["requests"]
+    assert crawler.reprocess(processes=1) == {}
+    assert len(os.listdir(crawler.posts_dir)) == 2
+    assert stand_in.stats["requests"] == requests_before
+
+
+def test_reprocess_without_archive_is_rejected(wechat_crawler):
+    with pytest.raises(ValueError, match="archive"):
+        wechat_crawler(archive=False).reprocess()
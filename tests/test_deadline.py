@@ -0,0 +1,48 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import postHelper
+
+
+def test_hedge_timing_excludes_rate_limit_wait():
+    policy = postHelper.HedgePolicy(min_samples=1, max_ratio=1.0, min_delay=0.01, workers=4)
+    sent = []
+
+    def request():
+        time.sleep(0.2)  # 在限速器排队
+        postHelper.mark_request_sent()
+        sent.append(time.monotonic())
+        time.sleep(0.01)
+        return "ok"
+
+    for _ in range(3):
+        assert policy.call("http://host.example/x", request) == "ok"
+    assert len(sent) == 3
+    assert max(policy._latencies["host.example"]) < 0.1
+
+
+def test_token_wait_respects_deadline():
+    bucket = postHelper.TokenBucket(rate=0.5, min_rate=0.1, max_rate=1, increase=0, decrease=0.5, burst=1,
+                                    latency_factor=4)
+    bucket.take()
+    start = time.monotonic()
+    with postHelper.deadline_scope(postHelper.Deadline(0.3)):
+        with pytest.raises(postHelper.DeadlineExceeded):
+            bucket.take()
+    assert time.monotonic() - start < 0.3
+
+
+def test_stuck_downloads_fail_article_at_deadline(stand_in, wechat_crawler):
+    crawler = wechat_crawler(article_timeout=1)
+    # 下载永远不返回：封面和正文图片都只能靠时限结束
+    crawler.downloader.submit = lambda url, dest_path: Future()
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(errors=crawler.crawl_batch(["p1"])), daemon=True)
+    worker.start()
+    worker.join(timeout=10)
+    assert not worker.is_alive()
+    assert list(result["errors"]) == ["p1"]
+    assert crawler.metrics.get("deadline_exceeded") == 1
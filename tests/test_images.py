@@ -0,0 +1,88 @@
+import os
+
+import postHelper
+
+DATA_URI = "data:image/png;base64,iVBORw0KGgo="
+
+
+def write_export(path, base_url):
+    content = (f'&lt;p&gt;intro&lt;/p&gt;&lt;img src="{DATA_URI}"/&gt;'
+               f'&lt;img src="{base_url}/img/x0/0.png"/&gt;&lt;img src="{base_url}/gone/1.png"/&gt;')
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom"><title>t</title>'
+                "<entry><title>Images</title>"
+                '<link rel="alternate" href="https://www.cnblogs.com/t/p/1.html"/>'
+                "<published>2020-01-02T08:00:00Z</published><author><name>t</name></author>"
+                f'<content type="html">{content}</content></entry></feed>\n')
+    return path
+
+
+def make_crawler(tmp_path, xml_file):
+    return postHelper.XmlArticleCrawler([xml_file], blog_root=str(tmp_path / "blog"), proxy=None)
+
+
+def test_permanent_failures_do_not_keep_article_stale(tmp_path, stand_in):
+    xml_file = write_export(str(tmp_path / "export.xml"), stand_in.base_url)
+    crawler = make_crawler(tmp_path, xml_file)
+    crawler.crawl()
+    (name,) = os.listdir(crawler.posts_dir)
+    with open(os.path.join(crawler.posts_dir, name), encoding="utf-8") as f:
+        assert DATA_URI in f.read()
+    assert crawler.metrics.get("download_failures") == 1
+
+    crawler = make_crawler(tmp_path, xml_file)
+    crawler.crawl()
+    assert crawler.metrics.get("articles_skipped") == 1
+
+
+def test_transient_failures_rerun_article(tmp_path, stand_in):
+    xml_file = write_export(str(tmp_path / "export.xml"), stand_in.base_url)
+    stand_in.config["respond"] = lambda path: 503 if path.startswith("/img/") else None
+    crawler = make_crawler(tmp_path, xml_file)
+    crawler.retry_policy.max_retries = 1
+    crawler.crawl()
+
+    stand_in.config["respond"] = None
+    crawler = make_crawler(tmp_path, xml_file)
+    crawler.crawl()
+    assert crawler.metrics.get("articles_skipped") == 0
+    assert crawler.metrics.get("images") == 1
+
+
+def test_thumbnail_only_derived_when_cover_shrinks(tmp_path):
+    from PIL import Image
+
+    processor = postHelper.AssetProcessor(thumbnail_size=100)
+    small_cover, large_cover = str(tmp_path / "small.png"), str(tmp_path / "large.png")
+    Image.new("RGB", (50, 40)).save(small_cover)
+    Image.new("RGB", (400, 200)).save(large_cover)
+    try:
+        assert processor.make_thumbnail(small_cover) is None
+        thumb = processor.make_thumbnail(large_cover)
+        with Image.open(thumb) as im:
+            assert max(im.size) == 100
+    finally:
+        processor.shutdown()
+
+
+def test_small_cover_keeps_original_thumbnail(stand_in, wechat_crawler):
+    crawler = wechat_crawler()
+    assert crawler.crawl_batch(["p1"]) == {}
+    (name,) = os.listdir(crawler.posts_dir)
+    with open(os.path.join(crawler.posts_dir, name), encoding="utf-8") as f:
+        front_matter = f.read()
+    assert "thumbnail-small" not in front_matter
+    assert "/thumbnail.png" in front_matter
+
+
+def test_content_types_do_not_accumulate(tmp_path, stand_in, wechat_crawler):
+    crawler = wechat_crawler()
+    assert crawler.crawl_batch(["p1", "p2"]) == {}
+    assert crawler.content_types == {}
+
+    planned = wechat_crawler(blog_root=str(tmp_path / "planned"))
+    with planned.planning():
+        planned.crawl_batch(["p1", "p2"])
+    assert planned.execute_plan() == []
+    assert planned.content_types == {}
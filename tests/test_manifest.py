@@ -0,0 +1,42 @@
+import os
+
+import benchmark
+import postHelper
+
+
+def make_xml_crawler(tmp_path, xml_file, **kwargs):
+    return postHelper.XmlArticleCrawler([xml_file], blog_root=str(tmp_path / "blog"), proxy=None,
+                                        download_images=False, **kwargs)
+
+
+def read_posts(crawler):
+    return {name: open(os.path.join(crawler.posts_dir, name), encoding="utf-8").read()
+            for name in os.listdir(crawler.posts_dir)}
+
+
+def test_category_change_invalidates_xml_posts(tmp_path):
+    xml_file = benchmark.generate_atom_export(str(tmp_path / "export.xml"), entries=3, images=0, paragraphs=2)
+    crawler = make_xml_crawler(tmp_path, xml_file)
+    crawler.crawl()
+    assert all("categories: Cnblogs" in text for text in read_posts(crawler).values())
+
+    url = "https://www.cnblogs.com/bench/p/100000.html"
+    crawler.save_category_file({"categories": {"1": {"title": "Django", "urls": [url]}}})
+    crawler = make_xml_crawler(tmp_path, xml_file)
+    crawler.crawl()
+    assert crawler.metrics.get("articles_skipped") == 2
+    assert sum("categories: Django" in text for text in read_posts(crawler).values()) == 1
+
+
+def test_unchanged_options_skip_and_changed_options_rerun(stand_in, wechat_crawler):
+    pids = ["p1", "p2"]
+    assert wechat_crawler().crawl_batch(pids) == {}
+
+    same = wechat_crawler()
+    same.crawl_batch(pids)
+    assert same.metrics.get("articles_skipped") == 2
+
+    changed = wechat_crawler(thumbnail_size=64)
+    changed.crawl_batch(pids)
+    assert changed.metrics.get("articles_skipped") == 0
+    assert changed.metrics.get("articles_written") == 2
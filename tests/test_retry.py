@@ -0,0 +1,34 @@
+import os
+import time
+
+import pytest
+import requests
+
+import postHelper
+from conftest import throttle_for
+
+
+def test_throttling_burst_slows_batch_without_failures(stand_in, wechat_crawler):
+    crawler = wechat_crawler(max_workers=4)
+    stand_in.config["respond"] = throttle_for(1.5)
+    start = time.monotonic()
+    errors = crawler.crawl_batch([f"p{i}" for i in range(12)])
+    assert errors == {}
+    assert len(os.listdir(crawler.posts_dir)) == 12
+    assert time.monotonic() - start >= 1.5
+    assert crawler.metrics.get("throttle_retries") > 0
+    breaker = crawler.retry_policy.breaker(stand_in.base_url.split("//")[1])
+    assert breaker.opened_at is None
+
+
+def test_connection_errors_still_open_breaker():
+    policy = postHelper.RetryPolicy(max_retries=2, base_delay=0, breaker_threshold=2)
+
+    def refuse(attempt):
+        raise requests.exceptions.ConnectionError("refused")
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        policy.call("http://down.example/x", refuse)
+    assert policy.breaker("down.example").opened_at is not None
+    with pytest.raises(postHelper.CircuitOpenError):
+        policy.call("http://down.example/x", refuse)
@@ -0,0 +1,62 @@
+import filecmp
+import os
+
+import pytest
+
+import postHelper
+
+PIDS = [f"p{i}" for i in range(8)]
+
+
+def tree(root):
+    """root 下全部文件的相对路径"""
+    return {os.path.relpath(os.path.join(d, name), root)
+            for sub in ("_posts", "images") for d, _, files in os.walk(os.path.join(root, sub)) for name in files}
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def test_shards_partition_and_merge_to_full_run(tmp_path, stand_in, wechat_crawler):
+    full = str(tmp_path / "full")
+    assert wechat_crawler(blog_root=full).crawl_batch(PIDS) == {}
+    nodes = [str(tmp_path / f"node{i}") for i in range(3)]
+    for i, node in enumerate(nodes):
+        assert wechat_crawler(blog_root=node, shard=f"{i}/3").crawl_batch(PIDS) == {}
+
+    posts = [set(os.listdir(os.path.join(node, "_posts"))) for node in nodes]
+    assert sum(map(len, posts)) == len(PIDS)
+    assert set().union(*posts) == set(os.listdir(os.path.join(full, "_posts")))
+
+    merged = str(tmp_path / "merged")
+    report = postHelper.merge_shards(nodes, merged, search_index=False)
+    assert report["conflicts"] == [] and report["collisions"] == {}
+    assert report["posts"] == len(PIDS)
+    assert tree(merged) == tree(full)
+    for path in tree(full):
+        assert filecmp.cmp(os.path.join(full, path), os.path.join(merged, path), shallow=False)
+
+
+def test_merge_reports_conflicts_and_collisions(tmp_path):
+    a, b, merged = str(tmp_path / "a"), str(tmp_path / "b"), str(tmp_path / "merged")
+    write(os.path.join(a, "_posts", "2024-01-01-aaaaaaaa.md"), "from a")
+    write(os.path.join(b, "_posts", "2024-01-01-aaaaaaaa.md"), "from b")
+    write(os.path.join(b, "_posts", "2024-02-02-aaaaaaaa.md"), "same id, other date")
+    write(os.path.join(a, "_posts", "2024-03-03-bbbbbbbb.md"), "identical")
+    write(os.path.join(b, "_posts", "2024-03-03-bbbbbbbb.md"), "identical")
+
+    report = postHelper.merge_shards([a, b], merged, search_index=False)
+    conflict_path = os.path.join("_posts", "2024-01-01-aaaaaaaa.md")
+    assert [c[0] for c in report["conflicts"]] == [conflict_path]
+    with open(os.path.join(merged, conflict_path), encoding="utf-8") as f:
+        assert f.read() == "from a"
+    assert report["collisions"] == {"aaaaaaaa": ["2024-01-01-aaaaaaaa.md", "2024-02-02-aaaaaaaa.md"]}
+
+
+@pytest.mark.parametrize("value", ["3/3", "1", "-1/2", "a/b", (0, 0)])
+def test_invalid_shard_rejected(value):
+    with pytest.raises(ValueError):
+        postHelper.parse_shard(value)
@@ -0,0 +1,17 @@
+import benchmark
+import postHelper
+import syncd
+
+
+def test_daemon_crawlers_share_components(tmp_path, stand_in):
+    blog_root = str(tmp_path / "blog")
+    queue = syncd.JobQueue(str(tmp_path / "jobs.sqlite"))
+    daemon = syncd.SyncDaemon(queue, blog_root=blog_root, proxy=None)
+    for name in postHelper.BaseMarkdownCrawler.SHARED_COMPONENTS:
+        assert getattr(daemon.xml, name) is getattr(daemon.wechat, name)
+
+    xml_file = benchmark.generate_atom_export(str(tmp_path / "export.xml"), entries=2, images=1, paragraphs=2,
+                                              base_url=stand_in.base_url, shared_images=0)
+    assert daemon.run_job({"kind": "xml", "target": xml_file}) == {"total": 2, "unchanged": 0, "failed": {}}
+    assert daemon.wechat.metrics.get("articles_written") == 2
+    assert daemon.run_job({"kind": "xml", "target": xml_file})["unchanged"] == 2
@@ -0,0 +1,14 @@
+def test_crawl_single_prints_unparseable_page(stand_in, wechat_crawler, capsys):
+    crawler = wechat_crawler()
+    url = stand_in.base_url + "/s/gone"
+    stand_in.config["respond"] = lambda path: 200 if path == "/s/gone" else None
+    assert crawler.crawl_single(url) is None
+    assert f"Failed to parse article: {url}" in capsys.readouterr().out
+
+
+def test_pipeline_records_unparseable_page_as_failure(stand_in, wechat_crawler):
+    crawler = wechat_crawler()
+    stand_in.config["respond"] = lambda path: 200 if path == "/s/gone" else None
+    errors = crawler.crawl_batch(["gone", "p1"])
+    assert list(errors) == ["gone"]
+    assert "ArticleParseError" in errors["gone"]